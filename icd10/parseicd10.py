@@ -1,73 +1,102 @@
 #########################################################################################################
-#                                  PARSING ICD-10 RAW TEXT INTO LOOKUP TABLE                            #
+#                                  PARSING ICD-10 RAW TEXT INTO LOOKUP TABLES                           #
 #                                                                                                       #
 #   Date:    December 2024                                                                              #
 #   Author:  Ethan Ward                                                                                 #
 #                                                                                                       #
 #   Purpose: This script parses the raw text form of the tabulated ICD-10 codes (from pdfs) into a      #
 #            workable lookup table, i.e. where each code has a description/definition, subcategory and  #
-#            category (three ascending hierarchical classifications of ICD codes). This is the 'full'   #
-#            version, which is concerned with all codes, i.e. including non-integer codes like A01.1    #
+#            category (three ascending hierarchical classifications of ICD codes). Both versions are    #
+#            produced from a single pass over the raw text: the 'full' version, which is concerned with #
+#            all codes, i.e. including non-integer codes like A01.1, and the 'part' version, which only #
+#            is concerned with the integer codes, i.e. A01 not A01.1.                                   #
 #                                                                                                       #
 #   Inputs:  - Raw text icd-10 codebook (icd10_rawtext.txt)                                             #
 #            - 'Valid subcategories' text file (icd10_subcategories_valid.txt) [to verify               #
 #               subcategories]                                                                          #
 #            - Common category categorization table (icdcategorisation.xlsx) [to add common icd-9 and   #
 #              icd-10 category as a column].                                                            #  
+#              Read through its cached json copy (icdcategorisation.json, see icd_categorisation.py).   #
 #                                                                                                       #
 #   Outputs: - ICD-10 'full' lookup table (parseicd10_full.csv)                                         #
+#            - ICD-10 'part' lookup table (parseicd10_part.csv)                                         #
+#            - Parquet and arrow copies of both (parseicd10_full/_part.parquet/.arrow)                  #
 #                                                                                                       #   
 #   Contents: 1. Defining subcat verification program                                                   #
 #             2. Defining parsing program:                                                              #
 #                   regex to identify code;                                                             #
 #                   regex to identify subcat;                                                           #
 #                   regex to identify cat                                                               #
-#             2. Defining merge with categorization table to add commoncat                              #
-#             3. Loading tables.                                                                        #
-#             4. Execute & Save                                                                         #
+#             3. Defining merge with categorization table to add commoncat                              #
+#             4. Splitting off 'part' table: integer codes, duplicates dropped                          #
+#             5. Execute & Save                                                                         #
 #                                                                                                       #
 #########################################################################################################
 
 # Loading packages
+import os
 import pandas as pd
 import re
+import sys
+
+# Shared modules are in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from icd_categorisation import load_categorisation
+from icd_columnar import write_columnar
+from icd_table import CodeTable
+
+## Precompiled patterns for each type of line
+chapter_pattern = re.compile(r'Chapter \d+\s*$')
+subcategory_pattern = re.compile(r'^([A-Z][\w\s,\[\]-]*?)( \(([A-Z]\d[A-Z0-9]?)(-[A-Z]\d[A-Z0-9]?)?\))$')
+code_pattern = re.compile(r'^([A-Z]\d[A-Z0-9]?(\.\d+)?([A-Z]?)?)\s+(.*)')
+# 'Part' codes: three characters total,
+# first char: letter, second char: digit, third char: digit or letter
+# Examples: a01, a1a, b20, c9z, etc.
+part_code_pattern = r'^[a-z]\d[a-z0-9]$'
 
 ## Defining subcategory validation using only subcategories which are in icd10_subcategories_valid.txt
+# Valid subcategories are held as a set of names (each line with and without its code range) for a hashed lookup,
+# plus all lines joined into one text for names that only appear as part of a line.
 def load_valid_subcategories(file_path):
     """ Load valid subcategories from a given file path """
     with open(file_path, 'r', encoding='utf-8') as file:
-        return [line.strip() for line in file.readlines()]
+        valid_lines = [line.strip() for line in file]
+    valid_names = set(valid_lines) | {line.split(' ', 1)[1] for line in valid_lines if ' ' in line}
+    return valid_names, '\n'.join(valid_lines)
 
 def is_valid_subcategory(name, valid_subcategories):
     """ Check if the subcategory name appears within any of the valid subcategories """
-    for valid_name in valid_subcategories:
-        if name in valid_name:
-            return True
-    return False
+    valid_names, valid_text = valid_subcategories
+    return name in valid_names or name in valid_text
 
 ## Defining parsing program ##
 # This is a regex program which aims to extract each code, subcategory header and category header.
 # There are clear patterns to which lines are which for the above, and the regex looks for these.
-def parse_text_to_csv(input_file_path, output_file_path, subcategory_file_path):
-    valid_subcategories = load_valid_subcategories(subcategory_file_path)
-
-    with open(input_file_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-
-    data = []
+# The raw text is streamed line by line through the parser, which yields one record per code.
+def read_lines(file):
+    """Yield each line of the raw text, stripped."""
+    for line in file:
+        yield line.strip()
+
+def parse_lines(lines, valid_subcategories):
+    """Yield a record (code, description, subcategory, category) for each code line."""
     current_category = None
     current_subcategory = None
     subcategory_active = False
+    category_next = False
+
+    for line in lines:
+        # The line after a chapter heading is the category title (and is then checked like any other line)
+        if category_next:
+            current_category = line.lower()
+            category_next = False
 
-    for i, line in enumerate(lines):
-        line = line.strip()
         # Checking if category
-        if re.match(r'Chapter \d+\s*$', line):
-            current_category = lines[i + 1].strip().lower()
-            i += 1
+        if chapter_pattern.match(line):
+            category_next = True
 
         # Checking if subcategory
-        elif match := re.match(r'^([A-Z][\w\s,\[\]-]*?)( \(([A-Z]\d[A-Z0-9]?)(-[A-Z]\d[A-Z0-9]?)?\))$', line):
+        elif (match := subcategory_pattern.match(line)):
             subcategory_name = match.group(1)
             if is_valid_subcategory(subcategory_name, valid_subcategories):
                 current_subcategory = subcategory_name.lower()
@@ -76,26 +105,35 @@ def parse_text_to_csv(input_file_path, output_file_path, subcategory_file_path):
                 print(f"Invalid or unrecognized subcategory: {subcategory_name}")
 
         # Checking if code (when subcategory is active)
-        elif subcategory_active and (match := re.match(r'^([A-Z]\d[A-Z0-9]?(\.\d+)?([A-Z]?)?)\s+(.*)', line)):
-            code = match.group(1).lower()           
-            full_description = match.group(4).lower() 
-            data.append({
+        elif subcategory_active and (match := code_pattern.match(line)):
+            code = match.group(1).lower()
+            full_description = match.group(4).lower()
+            yield {
                 'code': code,
                 'description': full_description,
                 'subcategory': current_subcategory,
                 'category': current_category
-            })
+            }
         else:
             # Flag 'codes' which appear outside active subcats
             if not subcategory_active and line:
                 print(f"Non-matching line outside subcategories: {line}")
 
+def parse_text_to_csv(input_file_path, full_output_file_path, part_output_file_path, subcategory_file_path,
+                      categorization_path):
+    valid_subcategories = load_valid_subcategories(subcategory_file_path)
+
+    # Records are collected in a compact table, with category/subcategory strings interned (icd_table.py)
+    data = CodeTable(['description', 'subcategory', 'category'])
+    with open(input_file_path, 'r', encoding='utf-8') as file:
+        for record in parse_lines(read_lines(file), valid_subcategories):
+            data.append(**record)
+
     # Create df
-    df = pd.DataFrame(data, dtype=str)
+    df = pd.DataFrame(data.to_columns(), dtype=str)
 
-    # Merging with the categorisation Excel file to get 'commoncat'
-    categorization_path = 'C:\\Users\\ethan\\Dropbox\\Gender Without Kids\\Data\\ICDcodes\\icdcategorisation.xlsx'
-    df_cat = pd.read_excel(categorization_path, dtype=str)
+    # Merging with the categorisation Excel file to get 'commoncat' (loaded once for both tables)
+    df_cat = load_categorisation(categorization_path)
 
     # To lowercase
     df_cat['icd10cat'] = df_cat['icd10cat'].str.lower()
@@ -113,15 +151,27 @@ def parse_text_to_csv(input_file_path, output_file_path, subcategory_file_path):
     # Drop the icd10cat column as not needed
     df_merged.drop(columns=['icd10cat'], inplace=True)
 
-    # Save the merged df to CSV
-    df_merged.to_csv(output_file_path, index=False)
+    # 'Part' table: integer codes only, dropping pure duplicates
+    df_part = df_merged[df_merged['code'].str.match(part_code_pattern)].drop_duplicates(subset=['code'], keep='first')
+
+    # Save the merged dfs to CSV
+    df_merged.to_csv(full_output_file_path, index=False)
+    df_part.to_csv(part_output_file_path, index=False)
+
+    # Columnar copies (parquet and arrow, with category columns dictionary encoded) next to each csv
+    write_columnar(df_merged, full_output_file_path)
+    write_columnar(df_part, part_output_file_path)
 
     print("Parsing and merging completed. The new file with commoncat column is saved.")
 
 # Paths
 processed_file_path = 'C:\\Users\\ethan\\Dropbox\\Gender Without Kids\\Data\\ICDcodes\\icd10\\icd10_rawtext.txt'
-csv_output_file_path = 'C:\\Users\\ethan\\Dropbox\\Gender Without Kids\\Data\\ICDcodes\\icd10\\parseicd10_full.csv'
+full_output_file_path = 'C:\\Users\\ethan\\Dropbox\\Gender Without Kids\\Data\\ICDcodes\\icd10\\parseicd10_full.csv'
+part_output_file_path = 'C:\\Users\\ethan\\Dropbox\\Gender Without Kids\\Data\\ICDcodes\\icd10\\parseicd10_part.csv'
 subcategory_file_path = 'C:\\Users\\ethan\\Dropbox\\Gender Without Kids\\Data\\ICDcodes\\icd10\\icd10_subcategories_valid.txt'
+categorization_path = 'C:\\Users\\ethan\\Dropbox\\Gender Without Kids\\Data\\ICDcodes\\icdcategorisation.xlsx'
 
-# Executing
-parse_text_to_csv(processed_file_path, csv_output_file_path, subcategory_file_path)
+# Executing (when run as a script, so parse_text_to_csv can also be imported)
+if __name__ == '__main__':
+    parse_text_to_csv(processed_file_path, full_output_file_path, part_output_file_path, subcategory_file_path,
+                      categorization_path)
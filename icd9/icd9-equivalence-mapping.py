@@ -4,32 +4,82 @@
 #  Date:      December 2024                                                                                                              #
 #  Author:    Ethan Ward                                                                                                                 #
 #                                                                                                                                        #
-#  Purpose:   This script completes the first part of the conversion of the old ICD-9 codes into their corresponding ICD-10              #
-#             'subcategories'. The second part is done manually, and the two tables are merged in another script                         #
-#             (merging_fuzzy_manual.R) The aim of this is to enable comparison across ICD-9 and ICD-10 codes at a level less granular    #
-#             than the codes themselves, for instance using EHRs.                                                                        #
+#  Purpose:   This script converts the old ICD-9 codes into their corresponding ICD-10 'subcategories'. The first part is fuzzy          #
+#             matching, done here. The second part is done manually (icd9_icd10_part_equivalence_manual.csv), and the two are            #
+#             merged at the end of this script. The aim of this is to enable comparison across ICD-9 and ICD-10 codes at a level         #
+#             less granular than the codes themselves, for instance using EHRs.                                                          #
 #                                                                                                                                        #
 #  Inputs:    - Parsed ICD-9 lookup table: parseicd9_part.csv                                                                            #
 #             - Parsed ICD-10 lookup table: parseicd10_part.csv                                                                          #
+#             - Manually matched ICD-9 codes: icd9_icd10_part_equivalence_manual.csv                                                     #
+#             - Full lookup tables, for full-code mapping only: parseicd9_full.csv, parseicd10_full.csv                                  #
 #                                                                                                                                        #
-#  Outputs:   - icd9_icd10_part_subcategory_equivalence_fuzzymatched.csv                                                                 #
+#  Outputs:   - icd9_icd10_part_subcategory_equivalence_merged.csv                                                                       #
+#             - icd9_icd10_full_code_equivalence.csv (full-code mapping only)                                                            #
+#             - Parquet and arrow copies of each output (.parquet/.arrow, category columns dictionary encoded)                           #
 #                                                                                                                                        #
 #  Contents:  1. Loading and preparing parsed lookup tables.                                                                             #
 #             2. Define dictionary of problematic subcategories which need to be skipped.                                                #
 #             3. Iterative fuzzy matching: first on subcategory, keeping only matches with same category, and which are a correct match  #
 #             (verified manually).                                                                                                       #
-#             4. Saving                                                                                                                  #
+#             Incrementally: matches are cached by their inputs, so a rerun only re-matches rows whose inputs changed.                   #
+#             Telemetry: per-stage timings, scorer work, cache hit rates and best scores near the cutoffs are written after the run.     #
+#             4. Merging with manual matches (previously merging_fuzzy_manual.R).                                                        #
+#             Optionally, full-code mapping: full icd-9 codes matched to full icd-10 codes, blocked by the part-level subcategory.       #
+#             5. Saving                                                                                                                  #
 #                                                                                                                                        #
 ##########################################################################################################################################
 
 # Loading packages
 import pandas as pd
+import numpy as np
 from rapidfuzz import process, fuzz
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
 import string
+import sys
+import time
+
+# Shared modules are in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from icd_columnar import write_columnar
+
+# Data folder (can be pointed elsewhere with the ICDCODES_DATA_PATH environment variable, e.g. by icd_benchmark.py)
+data_path = os.environ.get('ICDCODES_DATA_PATH', 'C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes')
 
 # Loading ICD-9 and ICD-10 lookup tables
-table_a = pd.read_csv('C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icd9/parseicd9_part.csv', dtype=str)
-table_b = pd.read_csv('C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icd10/parseicd10_part.csv', dtype=str)
+table_a = pd.read_csv(f'{data_path}/icd9/parseicd9_part.csv', dtype=str)
+table_b = pd.read_csv(f'{data_path}/icd10/parseicd10_part.csv', dtype=str)
+
+# Loading manually matched ICD-9 codes
+manual_table = pd.read_csv(f'{data_path}/icd9_icd10_part_equivalence_manual.csv', dtype=str)
+
+# Incremental matching: fuzzy matches are cached by their inputs, and only rows whose inputs changed are re-matched.
+# Set to False to re-match every code from scratch.
+incremental_matching = True
+match_cache_path = f'{data_path}/icd9/icd9_icd10_match_cache.json'
+
+# Score cache: the best match for each (query string, target set, scorer, cutoff) is kept on disk across runs, up to
+# score_cache_max_entries entries (least recently used evicted first). Set the path to None to disable.
+score_cache_path = f'{data_path}/icd9/icd9_icd10_score_cache.sqlite'
+score_cache_max_entries = 100000
+
+# Telemetry: per-stage timings, scorer work, cache hit rates and best scores near the cutoffs, written at the end of
+# the run as json, or as Prometheus text format if the path ends in .prom. Set the path to None to disable.
+telemetry_path = f'{data_path}/icd9/icd9_icd10_mapping_telemetry.json'
+
+# Parallel matching: number of processes the icd-9 rows are sharded across (None for one per core). With 1, matching
+# runs in this process (the scorer still spreads each batch over every core with threads).
+parallel_workers = 1
+
+# Full-code mapping: also match every full icd-9 code to a full icd-10 code (see Full-code mapping below). Needs the full
+# icd-10 table written by parseicd10.py.
+full_code_mapping = False
+full_code_output_path = f'{data_path}/icd9_icd10_full_code_equivalence.csv'
 
 ## Preparing the data ##
 # All cols to strings
@@ -48,10 +98,36 @@ def clean_description(desc):
 table_a['description_clean'] = table_a['description'].apply(clean_description)
 table_b['description_clean'] = table_b['description'].apply(clean_description)
 
+# Informative words of cleaned descriptions, for the inverted indexes used to prefilter description candidates
+stop_words = frozenset([
+    'a', 'an', 'and', 'as', 'at', 'by', 'due', 'for', 'from', 'in', 'into', 'of', 'on', 'or', 'the', 'to', 'with', 'without',
+    'other', 'specified', 'unspecified', 'elsewhere', 'classified', 'not', 'nos', 'nec'
+])
+
+def description_tokens(description_clean):
+    return set(description_clean.split()) - stop_words
+
+def build_token_index(descriptions):
+    """Inverted index: informative word -> positions (in order) of the descriptions containing it."""
+    token_index = {}
+    for position, description in enumerate(descriptions):
+        for token in description_tokens(description):
+            token_index.setdefault(token, []).append(position)
+    return {token: np.array(positions, dtype=np.intp) for token, positions in token_index.items()}
+
 # Preparing dictionaries for matching
 unique_b_subcategories = table_b['subcategory'].dropna().unique()
-description_to_info_b = table_b.set_index('description_clean')[['code', 'subcategory', 'commoncat', 'description']].to_dict('index')
-descriptions_b = table_b['description_clean'].dropna().unique()
+
+# Set of (subcategory, commoncat) pairs present in icd-10, to check subcategory matches stay within the same commoncat
+subcategory_commoncat_pairs_b = set(zip(table_b['subcategory'], table_b['commoncat']))
+
+# ICD-10 descriptions partitioned by commoncat, so that description matching only scores candidates in the same commoncat
+description_partitions_b = {
+    commoncat: partition.drop_duplicates('description_clean')[['description_clean', 'code', 'subcategory', 'description']]
+    for commoncat, partition in table_b.dropna(subset=['description_clean']).groupby('commoncat')
+}
+description_token_indexes_b = {commoncat: build_token_index(partition['description_clean'])
+                               for commoncat, partition in description_partitions_b.items()}
 
 # Problematic subcategories which need manual matching. 
 # When fuzzy matched, these subcategories do not match into icd-10 subcategories well.
@@ -115,67 +191,641 @@ skip_subcategories = [
     # Step 3: Fuzzy matching on description, i.e. remaining icd-9 codes get matched to specific CODES in icd-10, and icd-10 subcategories
     # are taken from those. (~15%).
     # Step 4: Manual matching on description. The remaining codes which cannot be automatically matched on code or description are
-    # manually assigned icd-10 subcategories, based on looking up equivalent icd-10 codes by hand. THIS STAGE IS NOT DONE IN THIS 
-    # SCRIPT, BUT RATHER IN THE SEPERATE R SCRIPT merging_fuzzy_manual.R. 
+    # manually assigned icd-10 subcategories, based on looking up equivalent icd-10 codes by hand. These are kept in
+    # icd9_icd10_part_equivalence_manual.csv, and merged in at the end of this script.
+
+# Manual subcategories
+manual_matches = {
+    "arthropod-borne viral diseases": ("Arthropod-borne viral fevers and viral haemorrhagic fevers", "manual", ''),
+    "viral diseases accompanied by exanthem": ("Viral infections characterized by skin and mucous membrane lesions", "manual", ''),
+    "carcinoma in situ": ("In situ neoplasms", "manual", ''),
+    "neoplasms of unspecified nature": ("Neoplasms of unspecified behavior", "manual", ''),
+    "appendicitis": ("Diseases of appendix", "manual", ''),
+    "hernia of abdominal cavity": ("Hernia", "manual", ''),
+    "ill-defined and unknown causes of morbidity and morality": ("Ill-defined and unknown cause of mortality", "manual", ''),
+    "fracture of skull": ("Injuries to the head", "manual", ''),
+    "fracture of spine and trunk": ("Injuries to the abdomen, lower back, lumber spine, pelvis and external genitals", "manual", ''),
+    "intracranial injury excluding those with skull fractures": ("Injuries to the head", "manual", ''),
+    "internal injury of chest, abdoment and pelvis": ("Injuries to the abdomen, lower back, lumber spine, pelvis and external genitals", "manual", '')
+}
+
+# Matcher configuration
+subcategory_cutoff = 80
+description_cutoff = 50
+scorer_workers = -1
+
+# Description prefilter: icd-10 descriptions sharing an informative word with the icd-9 description are scored first,
+# and the rest only against the best of those (see prefiltered_extract_one); the matches are the same either way.
+# Set to False to score every description in the commoncat in full.
+description_prefilter = True
+
+# Matcher backend of each stage: 'rapidfuzz' scores the candidates directly; 'tfidf' first shortlists the tfidf_top_k
+# most similar candidates by character n-gram TF-IDF cosine similarity, then scores only those (see tfidf_extract_one).
+# The 'tfidf' backend needs scipy.
+matcher_backends = {'subcategory': 'rapidfuzz', 'skipped_subcategory': 'rapidfuzz', 'description': 'rapidfuzz'}
+tfidf_ngram = 3
+tfidf_top_k = 10
+tfidf_chunk_size = 512
+
+## Telemetry ##
+# Counters per matching stage. batch_extract_one adds to the stage currently running (set by stage_timer).
+# Best scores are only recorded for queries actually scored (not those answered by a cache), in buckets from
+# score_window below to score_window above the cutoff.
+score_window = 10
+score_bucket_width = 2
+telemetry = {}
+current_stage = 'unstaged'
+
+def stage_metrics(stage):
+    return telemetry.setdefault(stage, {
+        'seconds': 0.0, 'rows': 0, 'matched_rows': 0,
+        'queries': 0, 'memo_hits': 0, 'score_cache_hits': 0, 'scored_queries': 0,
+        'scorer_calls': 0, 'candidates_scored': 0,
+        'cutoff': None, 'best_score_buckets': {}, 'best_score_count': 0, 'best_score_sum': 0.0
+    })
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Attribute the wall time, and the scorer work of batch_extract_one, of a block to a stage."""
+    global current_stage
+    previous_stage, current_stage = current_stage, stage
+    start = time.perf_counter()
+    try:
+        yield stage_metrics(stage)
+    finally:
+        stage_metrics(stage)['seconds'] += time.perf_counter() - start
+        current_stage = previous_stage
+
+def record_best_scores(metrics, best_scores, score_cutoff):
+    """Add best scores to the stage's cumulative (Prometheus style, upper bound 'le') buckets around the cutoff."""
+    metrics['cutoff'] = score_cutoff
+    bounds = list(range(score_cutoff - score_window, score_cutoff + score_window + 1, score_bucket_width)) + [float('inf')]
+    for bound in bounds:
+        key = str(bound) if bound != float('inf') else '+Inf'
+        metrics['best_score_buckets'][key] = metrics['best_score_buckets'].get(key, 0) + int((best_scores <= bound).sum())
+    metrics['best_score_count'] += len(best_scores)
+    metrics['best_score_sum'] += float(best_scores.sum())
+
+def telemetry_report():
+    """Telemetry as a dictionary, with the cache hit rate of each stage."""
+    report = {}
+    for stage, metrics in telemetry.items():
+        hits = metrics['memo_hits'] + metrics['score_cache_hits']
+        report[stage] = {**metrics, 'cache_hit_rate': hits / metrics['queries'] if metrics['queries'] else None}
+    return report
+
+def prometheus_text(report):
+    """Telemetry in the Prometheus text exposition format."""
+    lines = []
+    def add(name, kind, help_text, samples):
+        # Samples are (suffix, labels, value); the suffix is only used by the histogram (_bucket, _count, _sum)
+        lines.extend([f'# HELP icd_mapping_{name} {help_text}', f'# TYPE icd_mapping_{name} {kind}'])
+        lines.extend(f'icd_mapping_{name}{suffix}{{{labels}}} {value}' for suffix, labels, value in samples)
+
+    stages = list(report.items())
+    add('stage_seconds', 'gauge', 'Wall time spent in each matching stage.',
+        [('', f'stage="{stage}"', metrics['seconds']) for stage, metrics in stages])
+    add('stage_rows', 'gauge', 'Rows handled by each matching stage.',
+        [('', f'stage="{stage}"', metrics['rows']) for stage, metrics in stages])
+    add('stage_matched_rows', 'gauge', 'Rows given an icd-10 subcategory by each matching stage.',
+        [('', f'stage="{stage}"', metrics['matched_rows']) for stage, metrics in stages])
+    add('queries_total', 'counter', 'Distinct query strings, by where their best match came from.',
+        [('', f'stage="{stage}",source="{source}"', metrics[key]) for stage, metrics in stages
+         for source, key in (('memo', 'memo_hits'), ('score_cache', 'score_cache_hits'), ('scored', 'scored_queries'))])
+    add('scorer_calls_total', 'counter', 'Batched scorer (process.cdist) calls.',
+        [('', f'stage="{stage}"', metrics['scorer_calls']) for stage, metrics in stages])
+    add('candidates_scored_total', 'counter', 'Query/candidate pairs scored.',
+        [('', f'stage="{stage}"', metrics['candidates_scored']) for stage, metrics in stages])
+    add('cache_hit_ratio', 'gauge', 'Share of distinct queries answered by the memo or score cache.',
+        [('', f'stage="{stage}"', metrics['cache_hit_rate']) for stage, metrics in stages if metrics['cache_hit_rate'] is not None])
+    add('cutoff', 'gauge', 'Score cutoff of each stage.',
+        [('', f'stage="{stage}"', metrics['cutoff']) for stage, metrics in stages if metrics['cutoff'] is not None])
+    scored_stages = [(stage, metrics) for stage, metrics in stages if metrics['best_score_count']]
+    add('best_score', 'histogram', 'Best score of each scored query, around the cutoff.',
+        [('_bucket', f'stage="{stage}",le="{bound}"', count) for stage, metrics in scored_stages
+         for bound, count in metrics['best_score_buckets'].items()] +
+        [('_count', f'stage="{stage}"', metrics['best_score_count']) for stage, metrics in scored_stages] +
+        [('_sum', f'stage="{stage}"', metrics['best_score_sum']) for stage, metrics in scored_stages])
+    return '\n'.join(lines) + '\n'
+
+def write_telemetry(path):
+    report = telemetry_report()
+    with open(path, 'w', encoding='utf-8') as file:
+        if path.endswith('.prom'):
+            file.write(prometheus_text(report))
+        else:
+            json.dump(report, file, indent=1)
+
+def content_hash(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+## Score cache ##
+# Best matches are memoised for the run in score_memo, and optionally kept across runs in a sqlite table keyed on
+# the hash of (scorer, cutoff, target set, query).
+score_memo = {}
+
+# Parallel workers (find_best_matches_parallel) each open their own connection: with write-ahead logging readers do not
+# block the writer, and a worker waits up to score_cache_timeout seconds for another's write rather than failing.
+score_cache_timeout = 60
+
+def open_score_cache(path):
+    connection = sqlite3.connect(path, timeout=score_cache_timeout)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS best_match (key TEXT PRIMARY KEY, best INTEGER NOT NULL, last_used INTEGER NOT NULL)')
+    connection.execute('CREATE INDEX IF NOT EXISTS best_match_last_used ON best_match (last_used)')
+    evict_score_cache(connection)
+    return connection
+
+def evict_score_cache(connection):
+    """Drop the least recently used entries beyond score_cache_max_entries."""
+    connection.execute('DELETE FROM best_match WHERE key IN (SELECT key FROM best_match ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                       (score_cache_max_entries,))
+    connection.commit()
+
+def read_score_cache(keys):
+    """Cached best match for each of the keys found in the on-disk cache (marking them as used)."""
+    found = {}
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        found.update(score_cache.execute(f"SELECT key, best FROM best_match WHERE key IN ({','.join('?' * len(batch))})", batch))
+    score_cache.executemany('UPDATE best_match SET last_used = ? WHERE key = ?', [(time.time_ns(), key) for key in found])
+    # Committed straight away, so the write lock is not held while the connection is idle
+    score_cache.commit()
+    return found
+
+def write_score_cache(entries):
+    """Store new best matches, then evict the least recently used entries beyond the size limit."""
+    now = time.time_ns()
+    score_cache.executemany('INSERT OR REPLACE INTO best_match VALUES (?, ?, ?)', [(key, best, now) for key, best in entries.items()])
+    evict_score_cache(score_cache)
+
+score_cache = open_score_cache(score_cache_path) if score_cache_path else None
+
+## Batch matching engine ##
+# Rather than calling process.extractOne once per row, all queries are scored against all targets in a single
+# process.cdist call (spread over every core), and the best target per query is read off the score matrix.
+# Each distinct query is only scored once, and not at all if its best match is already in the score cache.
+def batch_extract_one(queries, choices, score_cutoff, token_index=None):
+    """
+    Return the index of the best scoring choice for each query, or -1 where no choice reaches the cutoff. With a
+    token_index of the choices (build_token_index), queries are scored by prefiltered_extract_one instead, and where
+    the backend of the current stage is 'tfidf', by tfidf_extract_one.
+    """
+    backend = matcher_backends.get(current_stage, 'rapidfuzz')
+    query_ids, unique_queries = pd.factorize(np.asarray(queries, dtype=object))
+    targets_hash = content_hash(fuzz.token_set_ratio.__name__, score_cutoff, list(choices))
+    # The prefiltered matches are the same as scoring every choice, so they share cache entries
+    if backend == 'tfidf':
+        targets_hash = content_hash('tfidf', tfidf_ngram, tfidf_top_k, targets_hash)
+    keys = [content_hash(targets_hash, query) for query in unique_queries]
+
+    metrics = stage_metrics(current_stage)
+    cached = {key: score_memo[key] for key in keys if key in score_memo}
+    metrics['memo_hits'] += len(cached)
+    if score_cache is not None and len(cached) < len(keys):
+        found = read_score_cache([key for key in keys if key not in cached])
+        metrics['score_cache_hits'] += len(found)
+        cached.update(found)
+    to_score = [i for i, key in enumerate(keys) if key not in cached]
+    metrics['queries'] += len(keys)
+
+    if to_score:
+        if backend == 'tfidf':
+            best, best_scores = tfidf_extract_one(unique_queries[to_score], choices, score_cutoff, targets_hash, metrics)
+        elif token_index is not None:
+            best, best_scores = prefiltered_extract_one(unique_queries[to_score], choices, score_cutoff, token_index, metrics)
+        else:
+            # Scored down to score_window below the cutoff, for the telemetry (the best match is the same: any choice at
+            # or above the cutoff still outscores these)
+            scores = process.cdist(unique_queries[to_score], choices, scorer=fuzz.token_set_ratio,
+                                   score_cutoff=max(score_cutoff - score_window, 0), dtype=np.float64,
+                                   workers=scorer_workers)
+            # argmax keeps the first of tied choices, as extractOne does
+            best = scores.argmax(axis=1)
+            best_scores = scores[np.arange(len(to_score)), best]
+            metrics['scorer_calls'] += 1
+            metrics['candidates_scored'] += len(to_score) * len(choices)
+        metrics['scored_queries'] += len(to_score)
+        record_best_scores(metrics, best_scores, score_cutoff)
+        scored = dict(zip([keys[i] for i in to_score], np.where(best_scores >= score_cutoff, best, -1).tolist()))
+        if score_cache is not None:
+            write_score_cache(scored)
+        cached.update(scored)
+
+    score_memo.update(cached)
+    return np.array([cached[key] for key in keys], dtype=np.intp)[query_ids]
+
+def prefiltered_extract_one(queries, choices, score_cutoff, token_index, metrics):
+    """
+    Best choice and its score for each query, the same as scoring every choice: the choices which share an informative
+    word with the query (found through the inverted token_index) are scored first, and the rest only need to be scored
+    with their best as the cutoff (which rapidfuzz uses to skip most of the work), as they only matter if they beat it,
+    or tie with it earlier in choices (as extractOne keeps the first of tied choices). Where no choice shares a word, or
+    none of those reaches the cutoff, every choice is scored, as without the prefilter.
+    """
+    lowest_score = max(score_cutoff - score_window, 0)
+    best = np.zeros(len(queries), dtype=np.intp)
+    best_scores = np.zeros(len(queries), dtype=np.float64)
+
+    for i, query in enumerate(queries):
+        match = None
+        shared = [token_index[token] for token in description_tokens(query) if token in token_index]
+        if shared:
+            positions = np.unique(np.concatenate(shared))
+            match = process.extractOne(query, choices[positions], scorer=fuzz.token_set_ratio, score_cutoff=lowest_score)
+            metrics['scorer_calls'] += 1
+            metrics['candidates_scored'] += len(positions)
+            if match is not None:
+                match = (match[0], match[1], positions[match[2]])
+        if match is not None and match[1] >= score_cutoff:
+            rest = np.ones(len(choices), dtype=bool)
+            rest[positions] = False
+            # A perfect score can only be tied, by a choice before it
+            if match[1] >= 100:
+                rest[match[2]:] = False
+            rest_positions = np.flatnonzero(rest)
+            rest_match = process.extractOne(query, choices[rest_positions], scorer=fuzz.token_set_ratio,
+                                            score_cutoff=match[1])
+            metrics['scorer_calls'] += 1
+            metrics['candidates_scored'] += len(rest_positions)
+            if rest_match is not None and (rest_match[1] > match[1] or rest_positions[rest_match[2]] < match[2]):
+                match = (rest_match[0], rest_match[1], rest_positions[rest_match[2]])
+        else:
+            match = process.extractOne(query, choices, scorer=fuzz.token_set_ratio, score_cutoff=lowest_score)
+            metrics['scorer_calls'] += 1
+            metrics['candidates_scored'] += len(choices)
+        if match is not None:
+            best[i], best_scores[i] = match[2], match[1]
+    return best, best_scores
 
-def find_best_match(row):
-    
-    default_return = ('', '', '')
+## TF-IDF matcher backend ##
+# Strings are embedded as TF-IDF weighted counts of their character n-grams (padded with a space at each end), as
+# sparse vectors of unit length. The cosine similarity of every query with every choice is then one sparse matrix
+# product, taken tfidf_chunk_size queries at a time so that memory stays bounded, and only the tfidf_top_k most
+# similar choices of each query are re-ranked with the fuzzy scorer. The fitted choice vectors are kept for the run.
+tfidf_models = {}
 
-    # Skip problematic subcategories
-    if row['subcategory'] in skip_subcategories:
-        subcategory, description_used = match_by_description(row['description_clean'], row['commoncat'])
-        return subcategory, 'skipped_subcategory', description_used if description_used else ''
+def char_ngrams(text):
+    text = f' {text} '
+    return [text[i:i + tfidf_ngram] for i in range(max(len(text) - tfidf_ngram + 1, 1))]
+
+def tfidf_vectors(texts, vocabulary, idf):
+    """Unit length TF-IDF vectors (csr matrix) of texts, over the n-grams of the vocabulary."""
+    from scipy import sparse
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        for ngram in char_ngrams(text):
+            column = vocabulary.get(ngram)
+            if column is not None:
+                rows.append(row)
+                columns.append(column)
+    counts = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(texts), len(vocabulary)))
+    counts.sum_duplicates()
+    vectors = counts.multiply(idf).tocsr()
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    return sparse.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)) @ vectors
+
+def tfidf_model(choices, targets_hash):
+    """n-gram vocabulary, idf weights and vectors of a set of choices."""
+    if targets_hash not in tfidf_models:
+        vocabulary = {}
+        document_frequency = []
+        for text in choices:
+            for ngram in set(char_ngrams(text)):
+                column = vocabulary.setdefault(ngram, len(vocabulary))
+                if column == len(document_frequency):
+                    document_frequency.append(0)
+                document_frequency[column] += 1
+        idf = np.log((1 + len(choices)) / (1 + np.array(document_frequency, dtype=np.float64))) + 1
+        tfidf_models[targets_hash] = (vocabulary, idf, tfidf_vectors(choices, vocabulary, idf).T.tocsr())
+    return tfidf_models[targets_hash]
+
+def tfidf_extract_one(queries, choices, score_cutoff, targets_hash, metrics):
+    """Best choice and its score for each query, scoring only the tfidf_top_k choices most similar by TF-IDF cosine."""
+    vocabulary, idf, choice_vectors = tfidf_model(choices, targets_hash)
+    lowest_score = max(score_cutoff - score_window, 0)
+    best = np.zeros(len(queries), dtype=np.intp)
+    best_scores = np.zeros(len(queries), dtype=np.float64)
+    top_k = min(tfidf_top_k, len(choices))
+
+    for start in range(0, len(queries), tfidf_chunk_size):
+        chunk = queries[start:start + tfidf_chunk_size]
+        similarities = (tfidf_vectors(chunk, vocabulary, idf) @ choice_vectors).toarray()
+        shortlists = np.argpartition(-similarities, top_k - 1, axis=1)[:, :top_k]
+        for i, (query, shortlist) in enumerate(zip(chunk, shortlists)):
+            # Choices with no n-gram in common are dropped; the rest are kept in their original order, so that ties
+            # are broken as by the rapidfuzz backend
+            shortlist = np.sort(shortlist[similarities[i, shortlist] > 0])
+            if not len(shortlist):
+                continue
+            match = process.extractOne(query, choices[shortlist], scorer=fuzz.token_set_ratio, score_cutoff=lowest_score)
+            metrics['scorer_calls'] += 1
+            metrics['candidates_scored'] += len(shortlist)
+            if match is not None:
+                best[start + i], best_scores[start + i] = shortlist[match[2]], match[1]
+    return best, best_scores
+
+def match_by_subcategory(subcategories, commoncats):
+    """Fuzzy match icd-9 subcategories onto icd-10 subcategories, keeping only those with the same commoncat."""
+    # Each distinct icd-9 subcategory is only scored once
+    unique_a_subcategories = subcategories.unique()
+    best = batch_extract_one(unique_a_subcategories, unique_b_subcategories, subcategory_cutoff)
+    best_subcategory = np.where(best >= 0, unique_b_subcategories[best], '')
+    matched_subcategory = subcategories.map(pd.Series(best_subcategory, index=unique_a_subcategories))
+
+    # Match only kept if the icd-10 subcategory has an entry in the same commoncat
+    same_commoncat = np.fromiter(((subcategory, commoncat) in subcategory_commoncat_pairs_b
+                                  for subcategory, commoncat in zip(matched_subcategory, commoncats)),
+                                 dtype=bool, count=len(matched_subcategory))
+    return matched_subcategory.where(same_commoncat, '')
+
+def match_by_description(descriptions, commoncats):
+    """Fuzzy match cleaned icd-9 descriptions onto the icd-10 descriptions sharing their commoncat."""
+    subcategory = pd.Series('', index=descriptions.index)
+    description_used = pd.Series('', index=descriptions.index)
+
+    for commoncat, group in descriptions.groupby(commoncats):
+        partition = description_partitions_b.get(commoncat)
+        if partition is None:
+            continue
+        token_index = description_token_indexes_b[commoncat] if description_prefilter else None
+        best = batch_extract_one(group.to_numpy(), partition['description_clean'].to_numpy(), description_cutoff, token_index)
+        matched = best >= 0
+        subcategory.loc[group.index[matched]] = partition['subcategory'].to_numpy()[best[matched]]
+        description_used.loc[group.index[matched]] = partition['description'].to_numpy()[best[matched]]
+    return subcategory, description_used
+
+def find_best_matches(table):
+    """Run the matching steps over the whole icd-9 table, returning icd10subcategory, MatchStage and MatchedBDescription."""
+    result = pd.DataFrame('', index=table.index, columns=['icd10subcategory', 'MatchStage', 'MatchedBDescription'])
+
+    # Skip problematic subcategories (matched by description below)
+    skipped = table['subcategory'].isin(skip_subcategories)
 
     # Manual subcategories
-    manual_matches = {
-        "arthropod-borne viral diseases": ("Arthropod-borne viral fevers and viral haemorrhagic fevers"),
-        "viral diseases accompanied by exanthem": ("Viral infections characterized by skin and mucous membrane lesions", "manual", ''),
-        "carcinoma in situ": ("In situ neoplasms", "manual", ''),
-        "neoplasms of unspecified nature": ("Neoplasms of unspecified behavior", "manual", ''),
-        "appendicitis": ("Diseases of appendix", "manual", ''),
-        "hernia of abdominal cavity": ("Hernia", "manual", ''),
-        "ill-defined and unknown causes of morbidity and morality": ("Ill-defined and unknown cause of mortality", "manual", ''),
-        "fracture of skull": ("Injuries to the head", "manual", ''),
-        "fracture of spine and trunk": ("Injuries to the abdomen, lower back, lumber spine, pelvis and external genitals", "manual", ''),
-        "intracranial injury excluding those with skull fractures": ("Injuries to the head", "manual", ''),
-        "internal injury of chest, abdoment and pelvis": ("Injuries to the abdomen, lower back, lumber spine, pelvis and external genitals", "manual", '')
-    }
-
-    if row['subcategory'] in manual_matches:
-        return manual_matches[row['subcategory']]
+    with stage_timer('manual') as metrics:
+        manual = ~skipped & table['subcategory'].isin(manual_matches.keys())
+        result.loc[manual] = pd.DataFrame([manual_matches[subcategory] for subcategory in table.loc[manual, 'subcategory']],
+                                          index=table.index[manual], columns=result.columns)
+        metrics['rows'] += int(manual.sum())
+        metrics['matched_rows'] += int(manual.sum())
 
     # Fuzzy subcategory matching
-    if row['subcategory']:
-        subcat_match = process.extractOne(row['subcategory'], unique_b_subcategories, scorer=fuzz.token_set_ratio, score_cutoff=80)
-        if subcat_match:
-            matched_subcategory = subcat_match[0]
-            entries = table_b[(table_b['subcategory'] == matched_subcategory) & (table_b['commoncat'] == row['commoncat'])]
-            if not entries.empty:
-                return matched_subcategory, 'subcategory', ''
-
-    # Fuzzy description matching
-    subcategory, description_used = match_by_description(row['description_clean'], row['commoncat'])
-    return subcategory, 'description', description_used if description_used else ''
-
-def match_by_description(description, commoncat):
-    desc_match = process.extractOne(description, descriptions_b, scorer=fuzz.token_set_ratio, score_cutoff=50)
-    if desc_match:
-        matched_description = desc_match[0]
-        match_info = description_to_info_b.get(matched_description)
-        if match_info and match_info['commoncat'] == commoncat:
-            return match_info['subcategory'], match_info['description']
-    return '', ''
-
-table_a[['icd10subcategory', 'MatchStage', 'MatchedBDescription']] = table_a.apply(lambda row: find_best_match(row), axis=1, result_type='expand')
-
-## Results ##
-total_codes = len(table_a)
-matched_count = table_a['icd10subcategory'].apply(bool).sum()
-unmatched_count = total_codes - matched_count
-
-## Saving ##
-table_a.to_csv('C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icd9_icd10_part_subcategory_equivalence_fuzzymatched.csv', index=False)
-print(f"Total codes in Table A: {total_codes}")
-print(f"Number of codes matched by subcategory or description: {matched_count}")
-print(f"Number of codes not matched at all: {unmatched_count}")
\ No newline at end of file
+    with stage_timer('subcategory') as metrics:
+        to_match = ~skipped & ~manual & (table['subcategory'] != '')
+        matched_subcategory = match_by_subcategory(table.loc[to_match, 'subcategory'], table.loc[to_match, 'commoncat'])
+        matched_subcategory = matched_subcategory[matched_subcategory != '']
+        result.loc[matched_subcategory.index, 'icd10subcategory'] = matched_subcategory
+        result.loc[matched_subcategory.index, 'MatchStage'] = 'subcategory'
+        metrics['rows'] += int(to_match.sum())
+        metrics['matched_rows'] += len(matched_subcategory)
+
+    # Fuzzy description matching, for skipped subcategories and then anything not matched so far
+    by_stage = [('skipped_subcategory', skipped), ('description', ~skipped & ~manual & (result['MatchStage'] == ''))]
+    for stage, by_description in by_stage:
+        with stage_timer(stage) as metrics:
+            subcategory, description_used = match_by_description(table.loc[by_description, 'description_clean'],
+                                                                 table.loc[by_description, 'commoncat'])
+            result.loc[by_description, 'icd10subcategory'] = subcategory
+            result.loc[by_description, 'MatchedBDescription'] = description_used
+            result.loc[by_description, 'MatchStage'] = stage
+            metrics['rows'] += int(by_description.sum())
+            metrics['matched_rows'] += int((subcategory != '').sum())
+    return result
+
+## Parallel matching ##
+# The icd-9 rows are split into contiguous shards (so codes of a subcategory mostly stay together) and matched by a
+# pool of processes. Only the shards are sent to the workers: the icd-10 targets (table_b, unique_b_subcategories,
+# description_partitions_b, ...) are module globals, which forked workers share with this process copy-on-write.
+# Where fork is not available (Windows), each worker builds them once when it imports this script.
+# Workers score single-threaded, use their own connection to the score cache, and send back their telemetry,
+# which is added to this process' (stage times are then summed over workers).
+def init_worker():
+    global score_cache, scorer_workers
+    scorer_workers = 1
+    score_cache = open_score_cache(score_cache_path) if score_cache_path else None
+
+def match_shard(shard):
+    telemetry.clear()
+    return find_best_matches(shard), telemetry
+
+def merge_telemetry(shard_telemetry):
+    for stage, shard_metrics in shard_telemetry.items():
+        metrics = stage_metrics(stage)
+        for name, value in shard_metrics.items():
+            if name == 'cutoff':
+                metrics[name] = value if value is not None else metrics[name]
+            elif name == 'best_score_buckets':
+                for bound, count in value.items():
+                    metrics[name][bound] = metrics[name].get(bound, 0) + count
+            else:
+                metrics[name] += value
+
+def find_best_matches_parallel(table, workers):
+    """find_best_matches over shards of the table, in a pool of processes."""
+    shards = [table.iloc[rows] for rows in np.array_split(np.arange(len(table)), min(workers, len(table)))]
+    start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    with multiprocessing.get_context(start_method).Pool(len(shards), initializer=init_worker) as pool:
+        outputs = pool.map(match_shard, shards)
+
+    for _, shard_telemetry in outputs:
+        merge_telemetry(shard_telemetry)
+    return pd.concat([result for result, _ in outputs])
+
+def run_matching(table):
+    """find_best_matches, over a pool of processes if parallel_workers is more than 1."""
+    workers = parallel_workers or os.cpu_count()
+    if workers > 1 and len(table) > 1:
+        return find_best_matches_parallel(table, workers)
+    return find_best_matches(table)
+
+## Incremental matching ##
+# Each row is keyed on a hash of everything its match depends on: its own inputs, how it is treated by
+# skip_subcategories/manual_matches, the icd-10 targets and the matcher configuration. Rows whose key is in the cache
+# from the previous run reuse the cached match; only the rest are re-matched. matcher_version is raised whenever the
+# matching code changes its results, so that matches cached by earlier versions are not reused.
+matcher_version = 2
+
+def match_keys(table):
+    """Cache key for each row of the icd-9 table."""
+    targets_hash = content_hash(table_b[['code', 'subcategory', 'commoncat', 'description', 'description_clean']].values.tolist())
+    config_hash = content_hash(matcher_version, fuzz.token_set_ratio.__name__, subcategory_cutoff, description_cutoff,
+                               sorted(matcher_backends.items()), tfidf_ngram, tfidf_top_k)
+    skipped = set(skip_subcategories)
+    return pd.Series([content_hash(code, subcategory, commoncat, description_clean, subcategory in skipped,
+                                   manual_matches.get(subcategory), targets_hash, config_hash)
+                      for code, subcategory, commoncat, description_clean in
+                      zip(table['code'], table['subcategory'], table['commoncat'], table['description_clean'])],
+                     index=table.index)
+
+def find_best_matches_incremental(table, cache_path):
+    """find_best_matches, re-matching only rows whose inputs are not in the cache, then updating the cache."""
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as file:
+            cache = json.load(file)
+
+    keys = match_keys(table)
+    cached = keys.isin(cache.keys())
+    result = pd.DataFrame([cache[key] if key in cache else ('', '', '') for key in keys], index=table.index,
+                          columns=['icd10subcategory', 'MatchStage', 'MatchedBDescription'])
+    if not cached.all():
+        result.loc[~cached] = run_matching(table.loc[~cached])
+    print(f"Incremental matching: {cached.sum()} codes reused from cache, {(~cached).sum()} re-matched")
+    # Rows reused from the match cache are reported as the cache hits of a 'match_cache' stage
+    metrics = stage_metrics('match_cache')
+    metrics['rows'] += len(table)
+    metrics['queries'] += len(table)
+    metrics['memo_hits'] += int(cached.sum())
+
+    # Only the current rows are kept, so the cache does not grow across runs
+    with open(cache_path, 'w', encoding='utf-8') as file:
+        json.dump(dict(zip(keys, result.values.tolist())), file)
+    return result
+
+## Merging with manual matches ##
+# Codes matched by hand take their icd-10 subcategory from the manual table. MatchStage is then relabelled in one pass,
+# in order of precedence: no conversion (NA), manual by code, manual by category, fuzzy by code, fuzzy by subcategory.
+def merge_manual_matches(fuzzy, manual):
+    merged = fuzzy[['code', 'description', 'subcategory', 'commoncat', 'icd10subcategory', 'MatchStage']].merge(
+        manual[['code', 'manual_icd10', 'subcategory_icd10']], on='code', how='left', sort=True)
+
+    has_manual = merged['manual_icd10'].notna()
+    icd10subcategory = merged['subcategory_icd10'].where(has_manual, merged['icd10subcategory']).replace('', 'no conversion')
+    stage = merged['MatchStage']
+    merged['MatchStage'] = np.select(
+        [icd10subcategory == 'no conversion',
+         has_manual & (merged['manual_icd10'] != 'no conversion'),
+         stage == 'manual',
+         stage == 'skipped_subcategory',
+         stage == 'subcategory'],
+        [None, 'manual by code', 'manual by category', 'fuzzy by code', 'fuzzy by subcategory'],
+        default=stage)
+    merged['icd10subcategory'] = icd10subcategory
+    return merged.drop(columns=['subcategory_icd10'])
+
+def write_merged_csv(merged, path):
+    """
+    Write the merged table in the format of the shipped csv (every value quoted, missing values as an unquoted NA,
+    CRLF line endings), so that regenerating it only changes the rows whose matches changed.
+    """
+    def quote(value):
+        return 'NA' if pd.isna(value) else '"' + str(value).replace('"', '""') + '"'
+    lines = [','.join(quote(column) for column in merged.columns)]
+    lines += [','.join(quote(value) for value in row) for row in merged.itertuples(index=False)]
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        file.write('\r\n'.join(lines) + '\r\n')
+
+## Full-code mapping ##
+# Every full icd-9 code (parseicd9_full.csv) is matched by description to a full icd-10 code (parseicd10_full.csv).
+# Scoring every pair would be quadratic, so the candidates of each code are blocked before any scoring:
+#     1. to the icd-10 subcategory already resolved for the code's 'part' code above, or, where it has none, to its
+#        commoncat;
+#     2. to the candidates sharing at least one word with the code's description (stop words aside), unless none do.
+# A code can then only be matched within its block: this trades a little recall for a much smaller number of scores.
+def read_full_table(path):
+    """Read a full lookup table, prepared as the part tables above."""
+    table = pd.read_csv(path, dtype=str).astype(str)
+    for col in ['subcategory', 'description', 'commoncat', 'code']:
+        table[col] = table[col].str.lower()
+    table['description_clean'] = table['description'].apply(clean_description)
+    return table
+
+def match_full_codes(full_a, full_b, part_subcategories):
+    """
+    Best full icd-10 code for each full icd-9 code, scored within its block. part_subcategories maps icd-9 part codes
+    to their (lowercase) icd-10 subcategory.
+    """
+    part_codes = full_a['code'].str.split('.').str[0]
+    block_subcategory = part_codes.map(part_subcategories).fillna('')
+    by_subcategory = block_subcategory.isin(set(full_b['subcategory'])).to_numpy()
+    block_keys = np.where(by_subcategory, 'subcategory:' + block_subcategory, 'commoncat:' + full_a['commoncat'])
+
+    targets = full_b.drop_duplicates('description_clean')
+    target_blocks = {**{'subcategory:' + key: block for key, block in targets.groupby('subcategory')},
+                     **{'commoncat:' + key: block for key, block in targets.groupby('commoncat')}}
+
+    result = pd.DataFrame({'code': full_a['code'], 'description': full_a['description'], 'part_code': part_codes,
+                           'icd10code': '', 'icd10description': '', 'icd10subcategory': '', 'score': np.nan,
+                           'MatchStage': None})
+    best_scores, matches = [], []
+    with stage_timer('full_code') as metrics:
+        for block_key, group in full_a.groupby(block_keys):
+            candidates = target_blocks.get(block_key)
+            if candidates is None:
+                continue
+            descriptions = candidates['description_clean'].to_numpy()
+
+            word_index = build_token_index(descriptions)
+
+            stage = 'full code by ' + block_key.split(':')[0]
+            for row, query in zip(group.index, group['description_clean']):
+                shared = [word_index[token] for token in description_tokens(query) if token in word_index]
+                positions = np.unique(np.concatenate(shared)) if shared else np.arange(len(descriptions))
+                match = process.extractOne(query, descriptions[positions], scorer=fuzz.token_set_ratio,
+                                           score_cutoff=max(description_cutoff - score_window, 0))
+                metrics['scorer_calls'] += 1
+                metrics['candidates_scored'] += len(positions)
+                best_scores.append(match[1] if match else 0.0)
+                if match and match[1] >= description_cutoff:
+                    target = candidates.index[positions[match[2]]]
+                    matches.append((row, target, match[1], stage))
+
+        if matches:
+            rows, target_rows, scores, stages = zip(*matches)
+            matched_targets = targets.loc[list(target_rows)]
+            result.loc[list(rows), 'icd10code'] = matched_targets['code'].to_numpy()
+            result.loc[list(rows), 'icd10description'] = matched_targets['description'].to_numpy()
+            result.loc[list(rows), 'icd10subcategory'] = matched_targets['subcategory'].to_numpy()
+            result.loc[list(rows), 'score'] = scores
+            result.loc[list(rows), 'MatchStage'] = stages
+        metrics['rows'] += len(full_a)
+        metrics['queries'] += len(full_a)
+        metrics['scored_queries'] += len(best_scores)
+        metrics['matched_rows'] += int(result['MatchStage'].notna().sum())
+        record_best_scores(metrics, np.array(best_scores), description_cutoff)
+    return result
+
+## Running ##
+# Only when run as a script, so the matching functions can also be imported (e.g. by icd_benchmark.py)
+if __name__ == '__main__':
+    if incremental_matching:
+        table_a[['icd10subcategory', 'MatchStage', 'MatchedBDescription']] = find_best_matches_incremental(table_a, match_cache_path)
+    else:
+        table_a[['icd10subcategory', 'MatchStage', 'MatchedBDescription']] = run_matching(table_a)
+
+    merged_conversion = merge_manual_matches(table_a, manual_table)
+
+    ## Results ##
+    total_codes = len(table_a)
+    matched_count = table_a['icd10subcategory'].apply(bool).sum()
+    unmatched_count = total_codes - matched_count
+    converted_count = (merged_conversion['icd10subcategory'] != 'no conversion').sum()
+
+    ## Saving ##
+    write_merged_csv(merged_conversion, f'{data_path}/icd9_icd10_part_subcategory_equivalence_merged.csv')
+    write_columnar(merged_conversion, f'{data_path}/icd9_icd10_part_subcategory_equivalence_merged.csv')
+    print(f"Total codes in Table A: {total_codes}")
+    print(f"Number of codes matched by subcategory or description: {matched_count}")
+    print(f"Number of codes not matched at all: {unmatched_count}")
+    print(f"Number of rows converted after merging manual matches: {converted_count} of {len(merged_conversion)}")
+
+    ## Full-code mapping ##
+    if full_code_mapping:
+        converted = merged_conversion[merged_conversion['MatchStage'].notna()].drop_duplicates('code')
+        part_subcategories = dict(zip(converted['code'], converted['icd10subcategory'].str.lower()))
+        full_a = read_full_table(f'{data_path}/icd9/parseicd9_full.csv')
+        full_b = read_full_table(f'{data_path}/icd10/parseicd10_full.csv')
+        full_conversion = match_full_codes(full_a, full_b, part_subcategories)
+        full_conversion.to_csv(full_code_output_path, index=False, na_rep='NA')
+        write_columnar(full_conversion, full_code_output_path)
+        print(f"Full codes matched: {full_conversion['MatchStage'].notna().sum()} of {len(full_conversion)}"
+              f" ({stage_metrics('full_code')['candidates_scored']} of {len(full_a) * len(full_b)} pairs scored)")
+
+    ## Telemetry ##
+    if telemetry_path:
+        write_telemetry(telemetry_path)
+        for stage, metrics in telemetry_report().items():
+            hit_rate = metrics['cache_hit_rate'] if metrics['cache_hit_rate'] is not None else float('nan')
+            print(f"  {stage:<20} {metrics['seconds']:7.3f} s  rows {metrics['rows']:5d}  "
+                  f"candidates scored {metrics['candidates_scored']:9d}  cache hit rate {hit_rate:.2f}")
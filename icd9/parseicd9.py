@@ -1,99 +1,103 @@
 #########################################################################################################
-#                                  PARSING ICD-9 RAW TEXT INTO LOOKUP TABLE                             #
+#                                  PARSING ICD-9 RAW TEXT INTO LOOKUP TABLES                            #
 #                                                                                                       #
 #   Date:    December 2024                                                                              #
 #   Author:  Ethan Ward                                                                                 #
 #                                                                                                       #
 #   Purpose: This script parses the raw text form of the tabulated ICD-9 codes (from pdfs) into a       #
 #            workable lookup table, i.e. where each code has a description/definition, subcategory and  #
-#            category (three ascending hierarchical classifications of ICD codes). This is the 'part'   #
-#            version, which only is concerned with the integer codes, i.e. 999 not 999.1.               #
+#            category (three ascending hierarchical classifications of ICD codes). Both versions are    #
+#            produced from a single pass over the raw text: the 'full' version, which includes all      #
+#            codes i.e. including 999.1, and the 'part' version, which only includes the integer codes, #
+#            i.e. 999 not 999.1.                                                                        #
 #                                                                                                       #
 #   Inputs:  - Raw text icd-9 codebook (icd9_rawtext.txt)                                               #
 #            - Common category categorization table (icdcategorisation.xlsx) [to add common icd-9 and   #
-#              icd-10 category as a column].                                                            #  
+#              icd-10 category as a column].                                                            #
+#              Read through its cached json copy (icdcategorisation.json, see icd_categorisation.py).   #
+#                                                                                                       #
+#   Outputs: - ICD-9 'full' lookup table (parseicd9_full.csv)                                           #
+#            - ICD-9 'part' lookup table (parseicd9_part.csv)                                           #
+#            - Parquet and arrow copies of both (parseicd9_full/_part.parquet/.arrow)                   #
 #                                                                                                       #
-#   Outputs: - ICD-9 'part' lookup table (parseicd9_part.csv)                                           #
-#                                                                                                       #   
 #   Contents: 1. Defining parsing program:                                                              #
 #                   regex to identify code;                                                             #
 #                   regex to identify subcat;                                                           #
 #                   regex to identify cat;                                                              #
-#                   small cleaning/duplicates dropping where parsed erroneously                         #
 #             2. Define merge with categorization table to add commoncat                                #
-#             3. Loading tables.                                                                        #
+#             3. Splitting off 'part' table: integer codes, duplicates dropped                          #
 #             4. Execute & Save                                                                         #
 #                                                                                                       #
 #########################################################################################################
 
 # Loading packages
+import os
 import pandas as pd
 import re
-import openpyxl
-import numpy as np
+import sys
+
+# Shared modules are in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from icd_categorisation import load_categorisation
+from icd_columnar import write_columnar
+from icd_table import CodeTable
+
+## Precompiled patterns ##
+# Regex for 'code' lines - looks for pattern such as 123, V01 or 00A, with an optional decimal part
+code_pattern = re.compile(r'^([0-9]+|[VE][0-9]+|[0-9]{2}[A-Z])(\.\d+)?\s+(.*)')
+# Regex for 'subcategory' lines - a name followed by a code range, e.g. (001 – 009.3)
+subcategory_pattern = re.compile(r'^(.*?)\s+\(([VE]?\d+(\.\d+)?\s*[-–]\s*[VE]?\d+(\.\d+)?)\)$')
 
 ## Defining parsing program ##
 # This is a regex program which aims to extract each code, subcategory header and category header.
 # There are clear patterns to which lines are which for the above, and the regex looks for these.
-def parse_text_to_csv(input_file_path, output_file_path, categorization_path):
-    with open(input_file_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-
-    data = []
+def parse_lines(lines, flags):
+    """Return a table (code, description, category, subcategory, part) of every code line, with interned strings."""
+    data = CodeTable(['description', 'category', 'subcategory', 'part'])
     current_category = None
     current_subcategory = None
-    flags = {
-        'categories_without_subcategories': [],
-        'codes_with_inserted_decimal': []
-    }
 
-    # Skipping empty lines
     for idx, line in enumerate(lines):
         line = line.strip()
+        # Skipping empty lines
         if not line:
-            continue 
-        
+            continue
+
         # Checking if the line is a code
-        # Regex for 'code' lines - looks for pattern such as 123 or V01
-        code_match = re.match(r'^([0-9]+|[VE][0-9]+|[0-9]{2}[A-Z])(\.\d+)?\s+(.*)', line)
+        code_match = code_pattern.match(line)
         if code_match:
             code = code_match.group(1)
             decimal_part = code_match.group(2) if code_match.group(2) else ''
             description = code_match.group(3)
 
-            # Skiping codes that have a decimal (as this is the 'part' not 'full' lookup table)
-            if decimal_part:
-                continue
+            # 'Part' codes: integer codes, exactly three characters long
+            part = not decimal_part and len(code) == 3
+
+            # Insert decimal point if code has four digits and no decimal
+            if not decimal_part and len(code) == 4 and code[0].isdigit():
+                code = f"{code[:3]}.{code[3]}"
+                flags['codes_with_inserted_decimal'].append(code)
+            else:
+                code = code + decimal_part
 
             # Converting all to lowercase
             code = code.lower()
             description = description.lower()
-
-            # Veerifying code: must be exactly three characters long
-            if len(code) != 3:
-                continue
-
             category = current_category.lower() if current_category else ''
             subcategory = current_subcategory.lower() if current_subcategory else ''
 
-            data.append({
-                'code': code,
-                'description': description,
-                'category': category,
-                'subcategory': subcategory
-            })
+            data.append(code, description=description, category=category, subcategory=subcategory, part=part)
             continue
 
         # Checking if the line is a subcategory
-        subcategory_match = re.match(
-            r'^(.*?)\s+\(([VE]?\d+(\.\d+)?\s*[-–]\s*[VE]?\d+(\.\d+)?)\)$', line)
+        subcategory_match = subcategory_pattern.match(line)
         if subcategory_match:
             current_subcategory = subcategory_match.group(1).strip().lower()
             continue
 
-        # EXCEPTION 
+        # EXCEPTION
         # For 'ADDITIONAL DIAGNOSTIC CODES'
-        if line.strip().upper() == 'ADDITIONAL DIAGNOSTIC CODES':
+        if line.upper() == 'ADDITIONAL DIAGNOSTIC CODES':
             current_category = 'ADDITIONAL DIAGNOSTIC CODES'
             current_subcategory = 'ADDITIONAL DIAGNOSTIC CODES'
             continue
@@ -101,29 +105,40 @@ def parse_text_to_csv(input_file_path, output_file_path, categorization_path):
         # EXCEPTION
         # Treat 'SUPPLEMENTARY CLASSIFICATION OF FACTORS INFLUENCING HEATLH STATUS AND CONTACT WITH HEALTH SERVICES'
         # as a category line.
-        if line.strip().upper() == 'SUPPLEMENTARY CLASSIFICATION OF FACTORS INFLUENCING HEATLH STATUS AND CONTACT WITH HEALTH SERVICES':
+        if line.upper() == 'SUPPLEMENTARY CLASSIFICATION OF FACTORS INFLUENCING HEATLH STATUS AND CONTACT WITH HEALTH SERVICES':
             current_category = 'SUPPLEMENTARY CLASSIFICATION OF FACTORS INFLUENCING HEATLH STATUS AND CONTACT WITH HEALTH SERVICES'
             current_subcategory = 'PERSONS WITH HEALTH HAZARDS RELATED TO COMMUNICABLE DISEASES (V01 – V07.9)'
             continue
 
         # Checking if the line is a category
-        # We double check that the category is followed by a new sub-category to verify. 
+        # We double check that the category is followed by a new sub-category to verify.
         if idx + 1 < len(lines):
             next_line = lines[idx + 1].strip()
-            next_is_subcategory = re.match(
-                r'^(.*?)\s+\(([VE]?\d+(\.\d+)?\s*[-–]\s*[VE]?\d+(\.\d+)?)\)$', next_line)
-            if next_is_subcategory:
-                current_category = line.strip().lower()
-                current_subcategory = None 
+            if subcategory_pattern.match(next_line):
+                current_category = line.lower()
+                current_subcategory = None
             else:
-                flags['categories_without_subcategories'].append(line.strip())
+                flags['categories_without_subcategories'].append(line)
             continue
 
+    return data
+
+def parse_text_to_csv(input_file_path, full_output_file_path, part_output_file_path, categorization_path):
+    with open(input_file_path, 'r', encoding='utf-8') as file:
+        lines = file.readlines()
+
+    flags = {
+        'categories_without_subcategories': [],
+        'codes_with_inserted_decimal': []
+    }
+
     # Create df
-    df = pd.DataFrame(data, dtype=str)
+    df = pd.DataFrame(parse_lines(lines, flags).to_columns())
+    is_part = df.pop('part').astype(bool)
+    df = df.astype(str)
 
-    # Merge with the categorization excel to add commoncat column.
-    df_cat = pd.read_excel(categorization_path, dtype=str)
+    # Merge with the categorization excel to add commoncat column (loaded once for both tables).
+    df_cat = load_categorisation(categorization_path)
 
     # Ensure icd9cat and commoncat are lowercase in categorization excel
     df_cat['icd9cat'] = df_cat['icd9cat'].str.lower()
@@ -135,11 +150,16 @@ def parse_text_to_csv(input_file_path, output_file_path, categorization_path):
     # Drop the icd9cat column as not needed
     df_merged.drop(columns=['icd9cat'], inplace=True)
 
-    # Dropping pure duplicates
-    df_merged = df_merged.drop_duplicates(subset=['code'], keep='first')
+    # 'Part' table: integer codes only, dropping pure duplicates
+    df_part = df_merged[is_part.to_numpy()].drop_duplicates(subset=['code'], keep='first')
+
+    # Save the merged dfs to csv
+    df_merged.to_csv(full_output_file_path, index=False)
+    df_part.to_csv(part_output_file_path, index=False)
 
-    # Save the merged df to csv
-    df_merged.to_csv(output_file_path, index=False)
+    # Columnar copies (parquet and arrow, with category columns dictionary encoded) next to each csv
+    write_columnar(df_merged, full_output_file_path)
+    write_columnar(df_part, part_output_file_path)
 
     # Print flags
     if flags['categories_without_subcategories']:
@@ -154,8 +174,10 @@ def parse_text_to_csv(input_file_path, output_file_path, categorization_path):
 
 # Paths
 input_file_path = 'C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icd9/icd9_rawtext.txt'
-output_file_path = 'C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icd9/parseicd9_part.csv'
+full_output_file_path = 'C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icd9/parseicd9_full.csv'
+part_output_file_path = 'C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icd9/parseicd9_part.csv'
 categorization_path = 'C:/Users/ethan/Dropbox/Gender Without Kids/Data/ICDcodes/icdcategorisation.xlsx'
 
-# Execute
-parse_text_to_csv(input_file_path, output_file_path, categorization_path)
+# Execute (when run as a script, so parse_text_to_csv can also be imported)
+if __name__ == '__main__':
+    parse_text_to_csv(input_file_path, full_output_file_path, part_output_file_path, categorization_path)
@@ -0,0 +1,237 @@
+#########################################################################################################
+#                                  COMPILED (MEMORY-MAPPED) ICD LOOKUP                                  #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: icd_lookup.py needs pandas and a parse of every csv before it can resolve a single code.   #
+#            This compiles the same lookup tables and conversion into one binary file, which lookup     #
+#            processes memory-map rather than load: startup only reads a small header, and every        #
+#            process on a host shares the same pages of the file instead of holding its own copy.       #
+#                                                                                                       #
+#            File layout: an 8 byte magic, the length of a json header, the json header (the size,      #
+#            modification time and sha256 of each source csv, and the name, dtype, shape and offset of  #
+#            each array), then the arrays, each aligned to 64 bytes:                                    #
+#                 string pool: every distinct string, utf-8 encoded back to back, with an offsets array #
+#                 per table: codes (without decimal point) as a sorted fixed-width array, and for each  #
+#                 column an array of integer ids into the string pool                                   #
+#            Opening the file warns if a source csv has changed since it was compiled (one whose size   #
+#            or modification time differs is hashed, so a fresh checkout of the same csvs is accepted). #
+#                                                                                                       #
+#   Inputs:  - The lookup tables, through icd_lookup.py (compile step only)                             #
+#                                                                                                       #
+#   Outputs: - Compiled lookup file (icd_lookup.bin)                                                    #
+#                                                                                                       #
+#   Usage:   python icd_artifact.py                     (compile)                                       #
+#            from icd_artifact import lookup_icd9, lookup_icd10, convert_9_to_10                        #
+#            (same functions and results as icd_lookup.py, read from the compiled file)                 #
+#                                                                                                       #
+#   Contents: 1. Compiling                                                                              #
+#             2. Memory-mapping                                                                         #
+#             3. Lookup functions                                                                       #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import hashlib
+import json
+import mmap
+import os
+import struct
+import warnings
+import numpy as np
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+artifact_path = os.path.join(base_path, 'icd_lookup.bin')
+
+magic = b'ICDLKUP2'
+alignment = 64
+
+record_columns = ['code', 'description', 'subcategory', 'category', 'commoncat']
+conversion_columns = record_columns + ['MatchStage']
+
+def code_key(code):
+    """Codes are stored and searched without whitespace or decimal point, lowercase (as in icd_trie.py)."""
+    return ''.join(str(code).lower().split()).replace('.', '')
+
+## Source tables ##
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_stamps(paths):
+    """Size, modification time and sha256 of each source csv, keyed on its path (relative to this folder, if under it)."""
+    stamps = {}
+    for path in paths:
+        stat = os.stat(path)
+        name = os.path.relpath(path, base_path) if os.path.abspath(path).startswith(base_path + os.sep) else os.path.abspath(path)
+        stamps[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(path)}
+    return stamps
+
+def changed_sources(stamps):
+    """
+    Source csvs which differ from when the file was compiled. Files of the same size and modification time are taken
+    as unchanged without being read; others are compared by hash. Missing sources (e.g. a file deployed without the
+    csvs) are not checked.
+    """
+    changed = []
+    for name, stamp in stamps.items():
+        path = os.path.join(base_path, name)
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) == (stamp['size'], stamp['mtime_ns']):
+            continue
+        if stat.st_size != stamp['size'] or file_hash(path) != stamp['sha256']:
+            changed.append(name)
+    return changed
+
+## Compiling ##
+def compile_artifact(output_path=artifact_path):
+    """Build the compiled lookup file from the tables loaded by icd_lookup.py."""
+    import icd_lookup
+    tables = icd_lookup.load_tables()
+
+    strings = {}
+    def string_id(value):
+        return strings.setdefault(value, len(strings))
+
+    arrays = {}
+    def add_table(name, records):
+        # Sorted by code key, so codes can be found by binary search
+        records = sorted(records, key=lambda record: code_key(record['code']))
+        keys = [code_key(record['code']).encode('ascii') for record in records]
+        # (an empty table, e.g. of no conversions, gets a zero-length key array, in which every code is a miss)
+        arrays[f'{name}/keys'] = np.array(keys, dtype=f"S{max((len(key) for key in keys), default=1)}")
+        for column in (conversion_columns if name == 'conversion' else record_columns):
+            arrays[f'{name}/{column}'] = np.array([string_id(record[column]) for record in records], dtype=np.int32)
+
+    add_table('icd9', [{'code': code, **record} for code, record in tables['icd9'].items()])
+    add_table('icd10', [{'code': code, **record} for code, record in tables['icd10'].items()])
+
+    # Conversions are resolved here with icd_lookup.convert_9_to_10, so the compiled results are identical
+    conversions = []
+    for code in tables['conversion']:
+        conversion = icd_lookup.convert_9_to_10(code)
+        if conversion is not None:
+            conversions.append({**conversion, 'code': code, 'icd10code': conversion['code']})
+    add_table('conversion', conversions)
+    arrays['conversion/icd10code'] = np.array([string_id(conversion['icd10code'])
+                                               for conversion in sorted(conversions, key=lambda c: code_key(c['code']))],
+                                              dtype=np.int32)
+
+    # String pool
+    encoded = [value.encode('utf-8') for value in strings]
+    arrays['strings/offsets'] = np.cumsum([0] + [len(value) for value in encoded], dtype=np.int64)
+    arrays['strings/data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    # Header, then the arrays at aligned offsets
+    directory, offset = {}, 0
+    for name, array in arrays.items():
+        directory[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // alignment) * alignment
+    sources = source_stamps([icd_lookup.icd9_path, icd_lookup.icd10_path, icd_lookup.equivalence_path])
+    header = json.dumps({'sources': sources, 'arrays': directory}).encode('utf-8')
+    data_start = -(-(len(magic) + 8 + len(header)) // alignment) * alignment
+
+    with open(output_path, 'wb') as file:
+        file.write(magic + struct.pack('<Q', len(header)) + header)
+        for name, array in arrays.items():
+            file.seek(data_start + directory[name]['offset'])
+            file.write(array.tobytes())
+        # Padded to its full length, so that empty arrays at the end still lie within the file
+        file.truncate(data_start + offset)
+    return output_path
+
+## Memory-mapping ##
+_artifact = None
+
+def open_artifact(path=artifact_path):
+    """
+    Memory-map a compiled lookup file. The arrays are read-only views onto the mapped file. Warns if any of the csvs
+    it was compiled from have changed since (recompile with python icd_artifact.py).
+    """
+    global _artifact
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapped[:len(magic)] != magic:
+        if mapped[:len(magic) - 1] == magic[:-1]:
+            raise ValueError(f"{path} was compiled in an older format: recompile it with python icd_artifact.py")
+        raise ValueError(f"{path} is not a compiled icd lookup file")
+    (header_length,) = struct.unpack('<Q', mapped[len(magic):len(magic) + 8])
+    header = json.loads(mapped[len(magic) + 8:len(magic) + 8 + header_length])
+    directory = header['arrays']
+
+    changed = changed_sources(header['sources'])
+    if changed:
+        warnings.warn(f"{path} is out of date: {', '.join(changed)} changed since it was compiled "
+                      f"(recompile it with python icd_artifact.py)", stacklevel=2)
+    data_start = -(-(len(magic) + 8 + header_length) // alignment) * alignment
+
+    arrays = {}
+    for name, entry in directory.items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + entry['offset'])
+
+    _artifact = {'mmap': mapped, 'arrays': arrays}
+    return _artifact
+
+def get_arrays():
+    """Return the mapped arrays, opening the default compiled file on first use."""
+    if _artifact is None:
+        open_artifact()
+    return _artifact['arrays']
+
+def get_string(arrays, string_id):
+    offsets = arrays['strings/offsets']
+    return arrays['strings/data'][offsets[string_id]:offsets[string_id + 1]].tobytes().decode('utf-8')
+
+def find_row(arrays, table, key):
+    """Row of a code key in a table, by binary search over its sorted keys (-1 if absent)."""
+    keys = arrays[f'{table}/keys']
+    key = key.encode('ascii', 'replace')
+    if not key or not len(keys) or len(key) > keys.dtype.itemsize:
+        return -1
+    row = int(np.searchsorted(keys, key))
+    return row if row < len(keys) and keys[row] == key else -1
+
+def resolve_row(arrays, table, code):
+    """Row of a code, or of its longest valid prefix if the code itself is unknown (as icd_trie.resolve_code)."""
+    key = code_key(code)
+    for length in range(len(key), 0, -1):
+        row = find_row(arrays, table, key[:length])
+        if row >= 0:
+            return row
+    return -1
+
+def read_record(arrays, table, row, columns):
+    return {column: get_string(arrays, arrays[f'{table}/{column}'][row]) for column in columns}
+
+## Lookup functions ##
+def lookup_icd9(code):
+    """Return the description, subcategory, category and commoncat of an icd-9 code (or its longest valid prefix)."""
+    arrays = get_arrays()
+    row = resolve_row(arrays, 'icd9', code)
+    return read_record(arrays, 'icd9', row, record_columns) if row >= 0 else None
+
+def lookup_icd10(code):
+    """Return the description, subcategory, category and commoncat of an icd-10 code (or its longest valid prefix)."""
+    arrays = get_arrays()
+    row = resolve_row(arrays, 'icd10', code)
+    return read_record(arrays, 'icd10', row, record_columns) if row >= 0 else None
+
+def convert_9_to_10(code):
+    """Return the icd-10 classification of an icd-9 code (by its 'part' code), or None if it has no conversion."""
+    arrays = get_arrays()
+    row = find_row(arrays, 'conversion', code_key(code)[:3])
+    if row < 0:
+        return None
+    conversion = read_record(arrays, 'conversion', row, conversion_columns[1:])
+    return {'code': get_string(arrays, arrays['conversion/icd10code'][row]), **conversion}
+
+if __name__ == '__main__':
+    print(f"Compiled lookup tables -> {compile_artifact()}")
@@ -0,0 +1,287 @@
+#########################################################################################################
+#                                     BENCHMARKS OF THE HOT PATHS                                       #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: Regression numbers for the slow parts of the pipeline, timed on the shipped data:          #
+#                 parsing: parse_text_to_csv for icd-9 and icd-10 (one pass writes the full and part    #
+#                 tables);                                                                              #
+#                 mapping: find_best_matches over the icd-9 part table (in this process, and over a     #
+#                 pool of one process per core), and match_by_description over every icd-9 description  #
+#                 (score caches off, so every run scores from scratch), and find_best_matches with the  #
+#                 TF-IDF backend, with its agreement with the default backends;                         #
+#                 lookup: single code lookups/conversions per second, through icd_lookup.py and the     #
+#                 compiled file of icd_artifact.py;                                                     #
+#                 bulk: convert_9_to_10_bulk over synthetic EHR-sized code columns (1M-100M rows);      #
+#                 phenotype: matching the same columns against synthetic phenotype definitions (code    #
+#                 ranges and wildcards, icd_phenotype.py).                                              #
+#            Each benchmark reports the best and median wall time over the repeats, and the peak        #
+#            memory allocated during one further run (traced separately, as tracing slows the run).     #
+#                                                                                                       #
+#   Inputs:  - The shipped raw text, parsed tables and manual matches (read only; outputs go to a       #
+#              temporary folder)                                                                        #
+#                                                                                                       #
+#   Outputs: - Results printed, and optionally saved as json (--output) and compared with an earlier    #
+#              json (--baseline)                                                                        #
+#                                                                                                       #
+#   Usage:   python icd_benchmark.py                                   (everything)                     #
+#            python icd_benchmark.py --stages bulk --rows 1000000 --output after.json --baseline b.json #
+#                                                                                                       #
+#   Contents: 1. Measuring                                                                              #
+#             2. Parsing benchmarks                                                                     #
+#             3. Mapping benchmarks                                                                     #
+#             4. Lookup and bulk conversion benchmarks                                                  #
+#             5. Phenotype benchmarks                                                                   #
+#             6. Command line                                                                           #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import argparse
+import contextlib
+import gc
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+categorisation_path = os.path.join(base_path, 'icdcategorisation.xlsx')
+
+stages = ['parse', 'mapping', 'lookup', 'bulk', 'phenotype']
+default_rows = [1_000_000, 10_000_000, 100_000_000]
+lookup_sample_size = 100_000
+phenotype_count = 200
+
+## Measuring ##
+def measure(name, function, repeats, items=None):
+    """Time a benchmark over the repeats, then trace one more run for its peak memory. Output is silenced."""
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            gc.collect()
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+        gc.collect()
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    result = {'name': name, 'seconds': min(times), 'median_seconds': float(np.median(times)), 'peak_mb': peak / 2**20}
+    if items:
+        result['items'] = items
+        result['items_per_second'] = items / min(times)
+    print_result(result)
+    return result
+
+def print_result(result, baseline=None):
+    line = f"{result['name']:<48} {result['seconds']:>9.3f} s (median {result['median_seconds']:.3f})  peak {result['peak_mb']:>8.1f} MB"
+    if 'items_per_second' in result:
+        line += f"  {result['items_per_second']:>12,.0f} /s"
+    if baseline:
+        line += f"  [{result['seconds'] / baseline['seconds']:.2f}x time, {result['peak_mb'] / max(baseline['peak_mb'], 1e-9):.2f}x memory vs baseline]"
+    print(line)
+
+def load_script(name, path):
+    """Import a script of the repository (which only runs its main section when run directly) as a module."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered, so its functions can be pickled by reference (for the process pool of the mapping script)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+## Parsing benchmarks ##
+def benchmark_parsing(repeats, output_folder):
+    parseicd9 = load_script('parseicd9', os.path.join(base_path, 'icd9', 'parseicd9.py'))
+    parseicd10 = load_script('parseicd10', os.path.join(base_path, 'icd10', 'parseicd10.py'))
+
+    def parse_icd9():
+        parseicd9.parse_text_to_csv(os.path.join(base_path, 'icd9', 'icd9_rawtext.txt'),
+                                    os.path.join(output_folder, 'parseicd9_full.csv'),
+                                    os.path.join(output_folder, 'parseicd9_part.csv'), categorisation_path)
+
+    def parse_icd10():
+        parseicd10.parse_text_to_csv(os.path.join(base_path, 'icd10', 'icd10_rawtext.txt'),
+                                     os.path.join(output_folder, 'parseicd10_full.csv'),
+                                     os.path.join(output_folder, 'parseicd10_part.csv'),
+                                     os.path.join(base_path, 'icd10', 'icd10_subcategories_valid.txt'), categorisation_path)
+
+    return [measure('parse_text_to_csv icd-9 (full + part)', parse_icd9, repeats),
+            measure('parse_text_to_csv icd-10 (full + part)', parse_icd10, repeats)]
+
+## Mapping benchmarks ##
+def benchmark_mapping(repeats, output_folder):
+    # The mapping script reads its inputs (and keeps its caches) under ICDCODES_DATA_PATH, so it is pointed at a copy
+    for folder in ('icd9', 'icd10'):
+        os.makedirs(os.path.join(output_folder, folder), exist_ok=True)
+    for path in ('icd9/parseicd9_part.csv', 'icd10/parseicd10_part.csv', 'icd9_icd10_part_equivalence_manual.csv'):
+        shutil.copy(os.path.join(base_path, path), os.path.join(output_folder, path))
+
+    previous_data_path = os.environ.get('ICDCODES_DATA_PATH')
+    os.environ['ICDCODES_DATA_PATH'] = output_folder
+    try:
+        mapping = load_script('icd9_equivalence_mapping', os.path.join(base_path, 'icd9', 'icd9-equivalence-mapping.py'))
+    finally:
+        if previous_data_path is None:
+            del os.environ['ICDCODES_DATA_PATH']
+        else:
+            os.environ['ICDCODES_DATA_PATH'] = previous_data_path
+
+    # Score caches off, so that every run scores from scratch
+    if mapping.score_cache is not None:
+        mapping.score_cache.close()
+        mapping.score_cache = None
+    mapping.score_cache_path = None
+
+    table_a = mapping.table_a
+
+    def find_best_matches():
+        mapping.score_memo.clear()
+        mapping.find_best_matches(table_a)
+
+    def match_by_description():
+        mapping.score_memo.clear()
+        mapping.match_by_description(table_a['description_clean'], table_a['commoncat'])
+
+    def find_best_matches_parallel():
+        mapping.score_memo.clear()
+        mapping.find_best_matches_parallel(table_a, os.cpu_count())
+
+    results = [measure('find_best_matches (icd-9 part table)', find_best_matches, repeats, len(table_a)),
+               measure(f'find_best_matches_parallel ({os.cpu_count()} processes)', find_best_matches_parallel, repeats,
+                       len(table_a)),
+               measure('match_by_description (every icd-9 code)', match_by_description, repeats, len(table_a))]
+
+    # The TF-IDF backend on every stage, with the share of codes given the same icd-10 subcategory as the default backends
+    default_backends = dict(mapping.matcher_backends)
+    mapping.score_memo.clear()
+    reference = mapping.find_best_matches(table_a)['icd10subcategory']
+    mapping.matcher_backends = {stage: 'tfidf' for stage in default_backends}
+    try:
+        result = measure(f'find_best_matches (tfidf backend, top {mapping.tfidf_top_k})', find_best_matches, repeats,
+                         len(table_a))
+        mapping.score_memo.clear()
+        result['agreement'] = float((mapping.find_best_matches(table_a)['icd10subcategory'] == reference).mean())
+        print(f"{'':<48} {result['agreement']:.1%} of codes matched as by the default backends")
+        results.append(result)
+    finally:
+        mapping.matcher_backends = default_backends
+    return results
+
+## Lookup and bulk conversion benchmarks ##
+def sample_codes(size, seed=0):
+    """
+    Synthetic column of icd-9 codes drawn from the lookup table, in the forms found in EHRs (with and without the
+    decimal point, upper case), with some unknown codes and missing values.
+    """
+    import icd_lookup
+    codes = np.array(list(icd_lookup.get_tables()['icd9']), dtype=object)
+    vocabulary = np.concatenate([codes, [code.replace('.', '') for code in codes], [code.upper() for code in codes],
+                                 ['999.99', 'xyz', '', None]])
+    rng = np.random.default_rng(seed)
+    return vocabulary[rng.integers(0, len(vocabulary), size)]
+
+def benchmark_lookup(repeats, output_folder):
+    import icd_lookup
+    import icd_artifact
+
+    codes = sample_codes(lookup_sample_size)
+    codes = [code for code in codes if code is not None]
+    icd_lookup.get_tables()
+    icd_artifact.open_artifact(icd_artifact.compile_artifact(os.path.join(output_folder, 'icd_lookup.bin')))
+
+    results = []
+    for module in (icd_lookup, icd_artifact):
+        for function in (module.lookup_icd9, module.convert_9_to_10):
+            def run(function=function):
+                for code in codes:
+                    function(code)
+            results.append(measure(f'{module.__name__}.{function.__name__}', run, repeats, len(codes)))
+    return results
+
+def benchmark_bulk(repeats, rows):
+    import icd_lookup
+    icd_lookup.get_tables()
+
+    results = []
+    for size in rows:
+        codes = sample_codes(size)
+        results.append(measure(f'convert_9_to_10_bulk ({size:,} rows)', lambda: icd_lookup.convert_9_to_10_bulk(codes),
+                               repeats, size))
+        del codes
+    return results
+
+## Phenotype benchmarks ##
+def sample_phenotypes(count, seed=0):
+    """Synthetic phenotype definitions: each a range over a few consecutive icd-9 part codes plus a wildcard code."""
+    import icd_lookup
+    parts = sorted(code for code in icd_lookup.get_tables()['icd9'] if len(code) == 3)
+    rng = np.random.default_rng(seed)
+    definitions = {}
+    for phenotype in range(count):
+        start = rng.integers(0, len(parts) - 5)
+        definitions[f'phenotype_{phenotype}'] = f'{parts[start]}-{parts[start + 4]}, {parts[rng.integers(len(parts))]}.x'
+    return definitions
+
+def benchmark_phenotypes(repeats, rows):
+    from icd_phenotype import PhenotypeMatcher
+    matcher = PhenotypeMatcher(sample_phenotypes(phenotype_count))
+
+    results = []
+    for size in rows:
+        codes = sample_codes(size)
+        results.append(measure(f'match_pairs ({size:,} rows, {phenotype_count} phenotypes)',
+                               lambda: matcher.match_pairs(codes), repeats, size))
+        del codes
+    return results
+
+## Command line ##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark parsing, matching and lookup on the shipped data.')
+    parser.add_argument('--stages', nargs='+', choices=stages, default=stages, help='benchmarks to run (default: all)')
+    parser.add_argument('--rows', nargs='+', type=int, default=default_rows, help='column sizes for the bulk and phenotype benchmarks')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per benchmark (default: 3)')
+    parser.add_argument('--output', help='save the results to this json file')
+    parser.add_argument('--baseline', help='compare with the results in this json file')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as output_folder:
+        if 'parse' in args.stages:
+            results += benchmark_parsing(args.repeats, output_folder)
+        if 'mapping' in args.stages:
+            results += benchmark_mapping(args.repeats, output_folder)
+        if 'lookup' in args.stages:
+            results += benchmark_lookup(args.repeats, output_folder)
+        if 'bulk' in args.stages:
+            results += benchmark_bulk(args.repeats, args.rows)
+        if 'phenotype' in args.stages:
+            results += benchmark_phenotypes(args.repeats, args.rows)
+
+    try:
+        import resource
+        print(f"\nPeak resident memory of the process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10:.0f} MB")
+    except ImportError:
+        pass
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = {result['name']: result for result in json.load(file)['results']}
+        print("\nCompared with baseline:")
+        for result in results:
+            if result['name'] in baseline:
+                print_result(result, baseline[result['name']])
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'python': sys.version, 'numpy': np.__version__, 'results': results}, file, indent=1)
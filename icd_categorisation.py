@@ -0,0 +1,67 @@
+#########################################################################################################
+#                                CACHED COMMON CATEGORISATION TABLE                                     #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: The common categorisation (icdcategorisation.xlsx) is needed by every parser to add the    #
+#            'commoncat' column, but reading it requires openpyxl and costs more than the merge itself. #
+#            This compiles the workbook into a small json file (icdcategorisation.json) which records   #
+#            the hash of the workbook it was built from. The json is reused for as long as the workbook  #
+#            is unchanged, and rebuilt automatically when it is edited.                                 #
+#                                                                                                       #
+#   Inputs:  - Common category categorization table (icdcategorisation.xlsx)                            #
+#                                                                                                       #
+#   Outputs: - Compiled categorisation table (icdcategorisation.json)                                   #
+#                                                                                                       #
+#   Usage:   python icd_categorisation.py            (compile / refresh the json)                       #
+#            df_cat = load_categorisation(path)       (in place of pd.read_excel(path, dtype=str))      #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import hashlib
+import json
+import os
+import pandas as pd
+
+categorisation_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icdcategorisation.xlsx')
+
+def cache_path_for(categorization_path):
+    """The compiled json sits next to the workbook, with the same name."""
+    return os.path.splitext(categorization_path)[0] + '.json'
+
+def file_hash(path):
+    """sha256 of a file's contents."""
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def compile_categorisation(categorization_path=categorisation_path):
+    """Read the workbook and write it, with its hash, to the json cache. Returns the table."""
+    df_cat = pd.read_excel(categorization_path, dtype=str)
+    cache = {
+        'source_sha256': file_hash(categorization_path),
+        'columns': list(df_cat.columns),
+        'rows': df_cat.astype(object).where(df_cat.notna(), None).values.tolist()
+    }
+    with open(cache_path_for(categorization_path), 'w', encoding='utf-8') as file:
+        json.dump(cache, file, indent=1)
+    return df_cat
+
+def load_categorisation(categorization_path=categorisation_path):
+    """
+    Return the categorisation table (icd9cat, icd10cat, commoncat as strings). Read from the json cache when it
+    was built from the current workbook, otherwise (re)compiled from the workbook. If only the json is present
+    (the workbook is not shipped) it is used as is.
+    """
+    cache_path = cache_path_for(categorization_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as file:
+            cache = json.load(file)
+        if not os.path.exists(categorization_path) or cache['source_sha256'] == file_hash(categorization_path):
+            return pd.DataFrame(cache['rows'], columns=cache['columns'], dtype=object)
+
+    return compile_categorisation(categorization_path)
+
+if __name__ == '__main__':
+    compile_categorisation()
+    print(f"Compiled {categorisation_path} -> {cache_path_for(categorisation_path)}")
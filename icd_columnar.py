@@ -0,0 +1,68 @@
+#########################################################################################################
+#                                 COLUMNAR (PARQUET / ARROW) TABLE OUTPUTS                              #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: The parsed and merged tables are written as csv, where the category, subcategory and       #
+#            commoncat strings are repeated in full on every row and re-parsed by every reader. Next to #
+#            each csv, the same table is also written as parquet and as an (uncompressed) arrow ipc     #
+#            file, with those columns dictionary encoded: each distinct string is stored once and rows  #
+#            hold a small integer code. The arrow file can be memory-mapped and read without copying or #
+#            parsing, and its dictionary columns arrive in pandas as categoricals.                      #
+#                                                                                                       #
+#   Usage:   write_columnar(df, 'parseicd9_full.csv')   -> parseicd9_full.parquet, parseicd9_full.arrow #
+#            read_columnar('parseicd9_full.csv')        -> df from parseicd9_full.arrow (None if absent #
+#                                                          or older than the csv)                       #
+#            Needs pyarrow; without it the columnar outputs are skipped and readers use the csvs.       #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import os
+
+# Columns with few distinct values, stored dictionary encoded
+dictionary_columns = ['category', 'subcategory', 'commoncat', 'icd10subcategory', 'MatchStage', 'subcategory_icd10',
+                      'category_icd10']
+
+def columnar_paths(csv_path):
+    base = os.path.splitext(csv_path)[0]
+    return base + '.parquet', base + '.arrow'
+
+def write_columnar(df, csv_path):
+    """Write a table as parquet and arrow ipc next to its csv. Returns False (with a note) if pyarrow is missing."""
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError:
+        print(f"pyarrow is not installed: parquet/arrow copies of {os.path.basename(csv_path)} not written")
+        return False
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, name in enumerate(table.column_names):
+        if name in dictionary_columns and pa.types.is_string(table.schema.field(name).type):
+            table = table.set_column(i, name, pc.dictionary_encode(table.column(name)))
+
+    parquet_path, arrow_path = columnar_paths(csv_path)
+    pq.write_table(table, parquet_path)
+    with pa.OSFile(arrow_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return True
+
+def read_columnar(csv_path):
+    """
+    The table of a csv from its arrow file, memory-mapped, as a DataFrame (dictionary columns as categoricals).
+    Returns None if there is no arrow file, it is older than the csv, or pyarrow is missing.
+    """
+    _, arrow_path = columnar_paths(csv_path)
+    if not os.path.exists(arrow_path):
+        return None
+    if os.path.exists(csv_path) and os.path.getmtime(arrow_path) < os.path.getmtime(csv_path):
+        return None
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+
+    with pa.memory_map(arrow_path, 'r') as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
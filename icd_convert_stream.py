@@ -0,0 +1,111 @@
+#########################################################################################################
+#                              STREAMING ICD-9 -> ICD-10 CONVERSION OF LARGE FILES                      #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: Adds the icd-10 classification (icd10subcategory, commoncat, MatchStage) of an icd-9 code  #
+#            column to a diagnosis file which is too large to load into memory. The file is read in     #
+#            fixed-size chunks, each chunk is converted with convert_9_to_10_bulk (icd_lookup.py) and   #
+#            written out straight away, so memory use depends on the chunk size and not the file size.  #
+#                                                                                                       #
+#   Inputs:  - Diagnosis file (.csv or .parquet) with a column of icd-9 codes                           #
+#            - Merged conversion table, through icd_lookup.py                                           #
+#                                                                                                       #
+#   Outputs: - The same file, in the same format, with the three conversion columns added (files which  #
+#              already have any of them, e.g. converted before, are rejected rather than given them     #
+#              twice)                                                                                   #
+#                                                                                                       #
+#   Usage:   python icd_convert_stream.py input.csv output.csv --code-column diag_code                  #
+#            or, from python, convert_file('input.parquet', 'output.parquet', 'diag_code')              #
+#                                                                                                       #
+#   Contents: 1. Chunked csv conversion                                                                 #
+#             2. Chunked parquet conversion                                                             #
+#             3. Command line                                                                           #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import argparse
+import os
+import pandas as pd
+
+from icd_lookup import convert_9_to_10_bulk
+
+default_chunksize = 1_000_000
+
+# Columns added by the conversion
+conversion_columns = ['icd10subcategory', 'commoncat', 'MatchStage']
+
+def check_columns(columns, code_column, input_path):
+    """Raise ValueError if the code column is missing, or the file already has any of the conversion columns."""
+    if code_column not in columns:
+        raise ValueError(f"{input_path} has no column {code_column!r}")
+    existing = [column for column in conversion_columns if column in columns]
+    if existing:
+        raise ValueError(f"{input_path} already has the conversion column(s) {', '.join(existing)} (converted before?)")
+
+## Chunked csv conversion ##
+def convert_csv(input_path, output_path, code_column, chunksize=default_chunksize):
+    """Convert a csv file chunk by chunk, appending each converted chunk to the output csv."""
+    check_columns(pd.read_csv(input_path, nrows=0).columns, code_column, input_path)
+
+    # Codes read as strings so leading zeros (e.g. 001) are kept
+    chunks = pd.read_csv(input_path, dtype={code_column: str}, chunksize=chunksize)
+    with open(output_path, 'w', encoding='utf-8', newline='') as output_file:
+        for i, chunk in enumerate(chunks):
+            converted = convert_9_to_10_bulk(chunk[code_column])
+            chunk = pd.concat([chunk, converted], axis=1)
+            chunk.to_csv(output_file, index=False, header=(i == 0))
+
+## Chunked parquet conversion ##
+def convert_parquet(input_path, output_path, code_column, chunksize=default_chunksize):
+    """Convert a parquet file batch by batch, writing each converted batch as a row group of the output file."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(input_path)
+    check_columns(parquet_file.schema_arrow.names, code_column, input_path)
+
+    writer = None
+    try:
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            # Arrow columns go straight into the bulk conversion without going through pandas
+            converted = convert_9_to_10_bulk(batch.column(code_column))
+            table = pa.Table.from_batches([batch])
+            for column in converted.columns:
+                table = table.append_column(column, pa.array(converted[column].to_numpy(), type=pa.string()))
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+
+        # A file without rows still gets an (empty) output, with the conversion columns added to its schema
+        if writer is None:
+            schema = parquet_file.schema_arrow
+            for column in conversion_columns:
+                schema = schema.append(pa.field(column, pa.string()))
+            writer = pq.ParquetWriter(output_path, schema)
+            writer.write_table(schema.empty_table())
+    finally:
+        if writer is not None:
+            writer.close()
+
+def convert_file(input_path, output_path, code_column, chunksize=default_chunksize):
+    """Convert a .csv or .parquet diagnosis file, chosen by the input file extension."""
+    extension = os.path.splitext(input_path)[1].lower()
+    if extension == '.csv':
+        convert_csv(input_path, output_path, code_column, chunksize)
+    elif extension in ('.parquet', '.pq'):
+        convert_parquet(input_path, output_path, code_column, chunksize)
+    else:
+        raise ValueError(f"Unsupported file type: {extension} (expected .csv or .parquet)")
+
+## Command line ##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add icd-10 classification columns to a large icd-9 diagnosis file.')
+    parser.add_argument('input_path')
+    parser.add_argument('output_path')
+    parser.add_argument('--code-column', default='code', help='column holding the icd-9 codes (default: code)')
+    parser.add_argument('--chunksize', type=int, default=default_chunksize, help='rows per chunk')
+    args = parser.parse_args()
+
+    convert_file(args.input_path, args.output_path, args.code_column, args.chunksize)
@@ -0,0 +1,283 @@
+#########################################################################################################
+#                                       ICD-9 / ICD-10 LOOKUP                                           #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: Importable lookup on top of the parsed tables, so that codes can be resolved in memory     #
+#            rather than every job reloading and merging the csvs. Each table is read once and held as  #
+#            a compact table indexed by code (icd_table.py), so resolving a code is a single hashed     #
+#            lookup.                                                                                    #
+#                                                                                                       #
+#   Inputs:  - ICD-9 'full' lookup table (parseicd9_full.csv)                                           #
+#            - ICD-10 lookup table (parseicd10_part.csv; the 'full' table is not shipped)               #
+#            - Merged conversion table (icd9_icd10_part_subcategory_equivalence_merged.csv)             #
+#            Each read from its arrow copy instead, where there is an up to date one (icd_columnar.py)  #
+#                                                                                                       #
+#   Usage:   from icd_lookup import lookup_icd9, lookup_icd10, convert_9_to_10                          #
+#            lookup_icd9('001.0')   -> {'code', 'description', 'subcategory', 'category', 'commoncat'}  #
+#            convert_9_to_10('001') -> as above for the icd-10 equivalent, plus 'MatchStage'            #
+#            Codes may be given in any common form (250.01, 25001, E11.65, e1165); they are normalised, #
+#            and unknown codes fall back to their longest valid prefix (tries of icd_trie.py)           #
+#            convert_9_to_10_bulk(codes) -> df of icd10subcategory, commoncat, MatchStage per code      #
+#            convert_10_to_9('E11.65') -> icd-9 codes converting to an icd-10 subcategory or code       #
+#            expand_10_to_9_bulk(keys) -> df of key, code: every icd-9 code of each subcategory/code    #
+#                                                                                                       #
+#   Contents: 1. Paths                                                                                  #
+#             2. Loading tables and building indexes                                                    #
+#             3. Lookup functions                                                                       #
+#             4. Bulk conversion                                                                        #
+#             5. Reverse (icd-10 -> icd-9) conversion                                                   #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import os
+import numpy as np
+import pandas as pd
+
+from icd_columnar import read_columnar
+from icd_table import CodeTable
+from icd_trie import build_code_trie, resolve_code
+
+## Paths ##
+base_path = os.path.dirname(os.path.abspath(__file__))
+icd9_path = os.path.join(base_path, 'icd9', 'parseicd9_full.csv')
+icd10_path = os.path.join(base_path, 'icd10', 'parseicd10_part.csv')
+equivalence_path = os.path.join(base_path, 'icd9_icd10_part_subcategory_equivalence_merged.csv')
+
+lookup_columns = ['description', 'subcategory', 'category', 'commoncat']
+
+## Loading tables and building indexes ##
+_tables = None
+
+def read_table(path):
+    """
+    Read a parsed table with every column as a string and missing values as ''. The table is read from its arrow copy
+    (see icd_columnar.py) where there is an up to date one, with its dictionary columns as categoricals, else from the csv.
+    """
+    df = read_columnar(path)
+    if df is None:
+        return pd.read_csv(path, dtype=str, keep_default_na=False, na_values=['NA']).fillna('')
+
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and '' not in df[column].cat.categories:
+            df[column] = df[column].cat.add_categories('')
+    return df.fillna('')
+
+def build_code_index(df, pools=None):
+    """
+    Code -> record index, keeping the first record where a code appears twice. Held as a compact CodeTable
+    (icd_table.py), with category/subcategory/commoncat strings interned in pools (shared between the tables).
+    """
+    df = df.drop_duplicates(subset=['code'], keep='first')
+    return CodeTable.from_columns(df['code'], {column: df[column] for column in lookup_columns}, pools)
+
+def build_reverse_index(keys, values):
+    """
+    Inverted index of key -> values in CSR form: (sorted pd.Index of the keys, offsets, values), where the values of
+    the i-th key are values[offsets[i]:offsets[i + 1]], in table order. Empty keys are left out.
+    """
+    keys = np.asarray(keys, dtype=object)
+    values = np.asarray(values, dtype=object)
+    keep = keys != ''
+    ids, uniques = pd.factorize(keys[keep], sort=True)
+    offsets = np.zeros(len(uniques) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=len(uniques)), out=offsets[1:])
+    return pd.Index(uniques), offsets, values[keep][np.argsort(ids, kind='stable')]
+
+def load_tables(icd9_file=None, icd10_file=None, equivalence_file=None):
+    """Load the lookup tables and build the code indexes. Called automatically on first lookup."""
+    global _tables
+
+    df_icd9 = read_table(icd9_file or icd9_path)
+    df_icd10 = read_table(icd10_file or icd10_path)
+    df_equivalence = read_table(equivalence_file or equivalence_path)
+
+    # String pools shared by the icd-9 and icd-10 code tables
+    pools = {}
+
+    # ICD-10 subcategory -> category/commoncat, to classify converted icd-9 codes
+    df_subcategories = df_icd10.drop_duplicates(subset=['subcategory'], keep='first')
+    subcategory_index = {subcategory: {'category': category, 'commoncat': commoncat}
+                         for subcategory, category, commoncat in
+                         zip(df_subcategories['subcategory'], df_subcategories['category'], df_subcategories['commoncat'])}
+
+    # ICD-9 part code -> icd-10 subcategory, match stage and manual icd-10 code (if any)
+    df_equivalence = df_equivalence.drop_duplicates(subset=['code'], keep='first')
+    conversion_index = {code: (subcategory.lower(), stage, manual_code)
+                        for code, subcategory, stage, manual_code in
+                        zip(df_equivalence['code'], df_equivalence['icd10subcategory'],
+                            df_equivalence['MatchStage'], df_equivalence['manual_icd10'])}
+
+    # The same conversion as parallel arrays for bulk conversion: codes are resolved to row ids, which index
+    # into the subcategory/commoncat/stage arrays. The final element is '' for codes without a conversion.
+    df_converted = df_equivalence[~df_equivalence['icd10subcategory'].str.lower().isin(['', 'no conversion'])]
+    conversion_codes = pd.Index(df_converted['code'])
+    conversion_subcategories = np.append(df_converted['icd10subcategory'].str.lower().to_numpy(dtype=object), '')
+    # commoncat of the icd-10 subcategory, as returned by convert_9_to_10 (not the merged table's own icd-9 commoncat)
+    conversion_commoncats = np.append([subcategory_index.get(subcategory, {}).get('commoncat', '')
+                                       for subcategory in conversion_subcategories[:-1]], '').astype(object)
+    conversion_stages = np.append(df_converted['MatchStage'].to_numpy(dtype=object), '')
+
+    # ICD-10 subcategory and manually matched icd-10 code -> icd-9 part codes converting to it, as one inverted index
+    # (subcategories are text and codes are 3 characters, so the two kinds of key cannot collide)
+    reverse_keys = pd.concat([df_converted['icd10subcategory'].str.lower(), df_converted['manual_icd10'].str.lower()])
+    reverse_index = build_reverse_index(reverse_keys, pd.concat([df_converted['code'], df_converted['code']]))
+
+    _tables = {
+        'icd9_trie': build_code_trie(pd.concat([df_icd9['code'], df_equivalence['code']]).unique()),
+        'icd10_trie': build_code_trie(df_icd10['code']),
+        'icd9': build_code_index(df_icd9, pools),
+        'icd10': build_code_index(df_icd10, pools),
+        'subcategories': subcategory_index,
+        'conversion': conversion_index,
+        'conversion_arrays': (conversion_codes, conversion_subcategories, conversion_commoncats, conversion_stages),
+        'reverse_conversion': reverse_index
+    }
+    return _tables
+
+def get_tables():
+    """Return the loaded indexes, loading them on first use."""
+    if _tables is None:
+        load_tables()
+    return _tables
+
+## Lookup functions ##
+def resolve_icd9(code):
+    """Normalise an icd-9 code: returns (table code or longest valid prefix, 'part' code, exact match)."""
+    return resolve_code(get_tables()['icd9_trie'], code)
+
+def resolve_icd10(code):
+    """Normalise an icd-10 code: returns (table code or longest valid prefix, 'part' code, exact match)."""
+    return resolve_code(get_tables()['icd10_trie'], code)
+
+def lookup_icd9(code):
+    """
+    Return the description, subcategory, category and commoncat of an icd-9 code (or of its longest valid
+    prefix, given as 'code', if the code itself is unknown), or None if nothing matches.
+    """
+    code, _, _ = resolve_icd9(code)
+    record = get_tables()['icd9'].get(code)
+    return {'code': code, **record} if record else None
+
+def lookup_icd10(code):
+    """
+    Return the description, subcategory, category and commoncat of an icd-10 code (or of its longest valid
+    prefix, given as 'code', if the code itself is unknown), or None if nothing matches.
+    """
+    code, _, _ = resolve_icd10(code)
+    record = get_tables()['icd10'].get(code)
+    return {'code': code, **record} if record else None
+
+def convert_9_to_10(code):
+    """
+    Return the icd-10 classification of an icd-9 code: icd-10 code (where manually matched), description,
+    subcategory, category, commoncat and MatchStage. Returns None if the code has no conversion.
+    """
+    tables = get_tables()
+
+    # The conversion is at the 'part' level, so full codes (e.g. 001.1) are looked up by their integer code
+    _, part_code, _ = resolve_code(tables['icd9_trie'], code)
+    conversion = tables['conversion'].get(part_code)
+    if conversion is None:
+        return None
+
+    subcategory, stage, manual_code = conversion
+    if subcategory in ('', 'no conversion'):
+        return None
+
+    # Manually matched codes also carry the description of their icd-10 code
+    record = tables['icd10'].get(manual_code) if manual_code not in ('', 'no conversion') else None
+    classification = tables['subcategories'].get(subcategory, {'category': '', 'commoncat': ''})
+    return {
+        'code': manual_code if record else '',
+        'description': record['description'] if record else '',
+        'subcategory': subcategory,
+        'category': classification['category'],
+        'commoncat': classification['commoncat'],
+        'MatchStage': stage
+    }
+
+## Bulk conversion ##
+def dictionary_encode(codes):
+    """Split a column of codes into its distinct values and an integer id per row (-1 for missing)."""
+    # Arrow arrays are dictionary encoded by arrow itself
+    if hasattr(codes, 'dictionary_encode'):
+        if hasattr(codes, 'combine_chunks'):
+            codes = codes.combine_chunks()
+        encoded = codes.dictionary_encode()
+        ids = encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+        return encoded.dictionary.to_pandas().astype(str), ids
+
+    ids, uniques = pd.factorize(codes if isinstance(codes, pd.Series) else np.asarray(codes, dtype=object))
+    return pd.Series(uniques).astype(str), ids
+
+def convert_9_to_10_bulk(codes):
+    """
+    Convert a whole column of icd-9 codes (numpy array, pandas Series or arrow array) to icd-10 subcategory,
+    commoncat and MatchStage. Codes are dictionary encoded, so each distinct code is normalised and looked up once and the
+    rows are filled by a single array gather. Codes without a conversion get ''.
+    """
+    tables = get_tables()
+    conversion_codes, conversion_subcategories, conversion_commoncats, conversion_stages = tables['conversion_arrays']
+
+    uniques, ids = dictionary_encode(codes)
+
+    # Resolve each distinct code to its row in the conversion arrays (full codes by their integer code)
+    part_codes = [resolve_code(tables['icd9_trie'], code)[1] for code in uniques]
+    unique_rows = conversion_codes.get_indexer(part_codes)
+
+    # -1 (unknown code, or missing value) indexes the trailing '' entry of the conversion arrays
+    unique_rows = np.append(unique_rows, -1)
+    rows = unique_rows[ids]
+
+    index = codes.index if isinstance(codes, pd.Series) else None
+    return pd.DataFrame({
+        'icd10subcategory': conversion_subcategories[rows],
+        'commoncat': conversion_commoncats[rows],
+        'MatchStage': conversion_stages[rows]
+    }, index=index)
+
+## Reverse (icd-10 -> icd-9) conversion ##
+def reverse_key(key, tables):
+    """Key of the reverse index for an icd-10 subcategory (any case) or icd-10 code (any common form, by its part code)."""
+    subcategory = key.strip().lower()
+    if subcategory in tables['reverse_conversion'][0]:
+        return subcategory
+    return resolve_code(tables['icd10_trie'], key)[1]
+
+def convert_10_to_9(key):
+    """
+    Return the icd-9 (part) codes which convert to an icd-10 subcategory, or to an icd-10 code (those manually matched
+    to it), as a list in table order; empty if there are none. Full icd-9 codes convert through their part code.
+    """
+    tables = get_tables()
+    reverse_keys, offsets, reverse_codes = tables['reverse_conversion']
+    row = reverse_keys.get_indexer([reverse_key(key, tables)])[0]
+    return list(reverse_codes[offsets[row]:offsets[row + 1]]) if row >= 0 else []
+
+def expand_10_to_9_bulk(keys):
+    """
+    Expand many icd-10 subcategories and/or codes (numpy array, pandas Series, list or arrow array) into the icd-9 codes
+    converting to each, as for convert_10_to_9. Returns a long df of key and icd-9 code, one row per pair, in the order
+    of the keys; keys without icd-9 codes have no rows. Each distinct key is resolved once, and the codes are gathered
+    from the inverted index with array operations, so e.g. df['code'].unique() is the icd-9 code set of a definition.
+    """
+    tables = get_tables()
+    reverse_keys, offsets, reverse_codes = tables['reverse_conversion']
+
+    uniques, ids = dictionary_encode(keys)
+    unique_rows = np.append(reverse_keys.get_indexer([reverse_key(key, tables) for key in uniques]), -1)
+    rows = unique_rows[ids]
+
+    # Keys found, with the start and length of their run of codes; each output row is its run start plus its position
+    found = np.flatnonzero(rows >= 0)
+    starts = offsets[rows[found]]
+    counts = offsets[rows[found] + 1] - starts
+    run_starts = np.cumsum(counts) - counts
+    positions = np.repeat(starts - run_starts, counts) + np.arange(counts.sum())
+
+    return pd.DataFrame({
+        'key': uniques.to_numpy(dtype=object)[np.repeat(ids[found], counts)],
+        'code': reverse_codes[positions]
+    })
@@ -0,0 +1,133 @@
+#########################################################################################################
+#                                  PHENOTYPE (CODE RANGE) MATCHING                                      #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: Cohort and phenotype definitions are written as codes, code ranges and wildcards, e.g.     #
+#            'E10-E14, 250.x, 001-009.3' (the range syntax of the codebook subcategory headers, '-' or  #
+#            '–'). Each definition is compiled into intervals over normalised codes (icd_trie.code_key: #
+#            lowercase, without the decimal point), where a code is in a range when it sorts between    #
+#            the two ends, counting every code under the upper end (E10-E14 takes in E14.9). The        #
+#            intervals of all the phenotypes are merged into one sorted table of boundaries, each       #
+#            segment between two boundaries marked with the phenotypes covering it. A column of codes   #
+#            is then matched with one vectorised binary search (np.searchsorted) per distinct code,     #
+#            and each row takes the phenotypes of its code's segment with a single array gather.        #
+#                                                                                                       #
+#   Terms:   E11, 250         the code and every code under it                                          #
+#            250.x, 250.1x    as above; trailing x/* after a digit or decimal point are wildcards       #
+#            E10-E14          every code from E10 to E14 and the codes under E14                        #
+#                                                                                                       #
+#   Usage:   matcher = PhenotypeMatcher({'diabetes': 'E10-E14, 250.x', 'cholera': '001, A00'})          #
+#            matcher.match(df['code'])        -> df of one boolean column per phenotype                 #
+#            matcher.match_pairs(df['code'])  -> long df of row, phenotype for each match               #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import re
+import numpy as np
+import pandas as pd
+
+from icd_lookup import dictionary_encode
+from icd_trie import code_key
+
+# Sorts after every character of a code, so that key + range_end is above every code under key
+range_end = b'\x7f'
+
+wildcard_pattern = re.compile(r'(?<=[\d.])[x*]+$')
+range_pattern = re.compile(r'\s*[-–]\s*')
+term_separator = re.compile(r'[,;\s]+')
+
+## Compiling definitions ##
+def term_key(term):
+    """Normalised key of one code of a definition, with any trailing wildcard removed."""
+    key = code_key(wildcard_pattern.sub('', term.strip().lower()).rstrip('.'))
+    if not key or not key.isascii() or not key.isalnum():
+        raise ValueError(f'not a code: {term!r}')
+    return key.encode('ascii')
+
+def parse_definition(definition):
+    """
+    Intervals [lower, upper) of normalised code keys (bytes) of a definition: a string of terms separated by commas,
+    semicolons or whitespace, or a list of terms. Raises ValueError for terms which are not codes or ranges.
+    """
+    terms = term_separator.split(range_pattern.sub('-', definition)) if isinstance(definition, str) else definition
+    intervals = []
+    for term in terms:
+        if not term:
+            continue
+        lower, _, upper = range_pattern.sub('-', term).partition('-')
+        lower = term_key(lower)
+        upper = term_key(upper) if upper else lower
+        if upper < lower[:len(upper)]:
+            raise ValueError(f'range ends before it starts: {term!r}')
+        intervals.append((lower, upper + range_end))
+    if not intervals:
+        raise ValueError(f'empty definition: {definition!r}')
+    return intervals
+
+class PhenotypeMatcher:
+    """
+    Phenotype definitions (a dictionary of name -> definition, see parse_definition) compiled into one sorted table of
+    interval boundaries, with a boolean row per segment between boundaries of the phenotypes covering it.
+    """
+    def __init__(self, definitions):
+        self.names = list(definitions)
+        intervals = [(lower, upper, phenotype) for phenotype, name in enumerate(self.names)
+                     for lower, upper in parse_definition(definitions[name])]
+        lowers, uppers, phenotypes = zip(*intervals)
+
+        # Keys are held as fixed-width bytes, so the binary search runs on numpy strings rather than python objects
+        self.width = max(len(bound) for bound in uppers)
+        self.boundaries = np.unique(np.array(lowers + uppers, dtype=f'S{self.width}'))
+
+        # Each interval adds 1 to its phenotype from the segment at its lower bound up to the one at its upper bound
+        counts = np.zeros((len(self.boundaries) + 1, len(self.names)), dtype=np.int32)
+        np.add.at(counts, (np.searchsorted(self.boundaries, np.array(lowers, dtype=self.boundaries.dtype)), phenotypes), 1)
+        np.add.at(counts, (np.searchsorted(self.boundaries, np.array(uppers, dtype=self.boundaries.dtype)), phenotypes), -1)
+
+        # The final row (segment -1) is for codes below the first boundary and missing codes, and is in no phenotype
+        self.membership = np.cumsum(counts, axis=0) > 0
+        self.membership[-1] = False
+
+    ## Matching ##
+    def code_segments(self, codes):
+        """Distinct-code -> segment ids (-1 for none, including a final -1 for missing codes) and the id of each row."""
+        uniques, ids = dictionary_encode(codes)
+        keys = np.array([code_key(code).encode('ascii', 'replace')[:self.width] for code in uniques],
+                        dtype=self.boundaries.dtype)
+        segments = np.searchsorted(self.boundaries, keys, side='right') - 1
+        return np.append(segments, -1), ids
+
+    def match(self, codes, names=None):
+        """
+        Match a column of codes (numpy array, pandas Series, list or arrow array) against the phenotypes (all, or those
+        named): a df with one boolean column per phenotype, True where the code is in it.
+        """
+        names = self.names if names is None else list(names)
+        segments, ids = self.code_segments(codes)
+        unique_membership = self.membership[segments]
+
+        index = codes.index if isinstance(codes, pd.Series) else None
+        return pd.DataFrame({name: unique_membership[:, self.names.index(name)][ids] for name in names}, index=index)
+
+    def match_pairs(self, codes):
+        """
+        Match a column of codes against every phenotype, as a long df of the row (position) and phenotype (categorical)
+        of each match, in row order. Rows in no phenotype have no pairs, so this stays small for many phenotypes.
+        """
+        segments, ids = self.code_segments(codes)
+        unique_codes, phenotypes = np.nonzero(self.membership[segments])
+
+        # Run of pairs of each distinct code; each row takes its code's run (missing codes, id -1, the final empty run)
+        unique_counts = np.bincount(unique_codes, minlength=len(segments))
+        unique_starts = np.cumsum(unique_counts) - unique_counts
+        starts = unique_starts[ids]
+        counts = unique_counts[ids]
+        run_starts = np.cumsum(counts) - counts
+        positions = np.repeat(starts - run_starts, counts) + np.arange(counts.sum())
+
+        return pd.DataFrame({
+            'row': np.repeat(np.arange(len(ids)), counts),
+            'phenotype': pd.Categorical.from_codes(phenotypes[positions], categories=self.names)
+        })
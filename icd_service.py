@@ -0,0 +1,214 @@
+#########################################################################################################
+#                                    ICD LOOKUP / CONVERSION SERVICE                                    #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: A small HTTP service (asyncio, standard library only) which loads the lookup tables and    #
+#            the merged conversion once, through icd_lookup.py, and serves lookups and conversions to   #
+#            every job, instead of each job re-reading the csvs. Conversion requests arriving within    #
+#            batch_window of each other are coalesced: their codes are converted together by a single   #
+#            convert_9_to_10_bulk call, and each request is answered with its own share of the result.  #
+#                                                                                                       #
+#   Endpoints: GET  /lookup/icd9/<code>, /lookup/icd10/<code>    -> record (404 if unknown)             #
+#              POST /lookup/icd9, /lookup/icd10  {"codes": [...]} -> {"results": [record or null, ...]} #
+#              GET  /convert/<code>                              -> conversion                          #
+#              POST /convert  {"codes": [...]}                   -> {"results": [conversion, ...]}      #
+#              GET  /health                                      -> status and batching counts          #
+#            Records are as returned by icd_lookup.lookup_icd9/lookup_icd10; conversions are the code   #
+#            with its icd10subcategory, commoncat and MatchStage ('' where there is no conversion).     #
+#                                                                                                       #
+#   Usage:   python icd_service.py --port 8080                                                          #
+#            curl localhost:8080/convert/250.01                                                         #
+#            curl -d '{"codes": ["001", "250.01"]}' localhost:8080/convert                              #
+#                                                                                                       #
+#   Contents: 1. Coalescing conversions                                                                 #
+#             2. Routing                                                                                #
+#             3. HTTP                                                                                   #
+#             4. Command line                                                                           #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+import argparse
+import asyncio
+import json
+import urllib.parse
+import numpy as np
+
+from icd_lookup import convert_9_to_10_bulk, get_tables, lookup_icd9, lookup_icd10
+
+default_batch_window = 0.002
+default_max_batch = 10_000
+max_body_size = 16 * 2**20
+
+## Coalescing conversions ##
+class ConversionBatcher:
+    """
+    Collects the codes of concurrent conversion requests, for up to batch_window seconds or until max_batch codes are
+    waiting, then converts them all with one convert_9_to_10_bulk call.
+    """
+    def __init__(self, batch_window=default_batch_window, max_batch=default_max_batch):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pending = []
+        self.pending_codes = 0
+        self.flush_handle = None
+        self.batches = 0
+        self.requests = 0
+        self.codes = 0
+
+    def convert(self, codes):
+        """Future of the conversions of a list of codes."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((codes, future))
+        self.pending_codes += len(codes)
+        if self.pending_codes >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self.flush)
+        return future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending, self.pending, self.pending_codes = self.pending, [], 0
+        if not pending:
+            return
+
+        codes = [code for request_codes, _ in pending for code in request_codes]
+        try:
+            converted = convert_9_to_10_bulk(np.array(codes, dtype=object))
+        except Exception as error:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        rows = [{'code': code, 'icd10subcategory': subcategory, 'commoncat': commoncat, 'MatchStage': stage}
+                for code, subcategory, commoncat, stage in
+                zip(codes, converted['icd10subcategory'], converted['commoncat'], converted['MatchStage'])]
+        start = 0
+        for request_codes, future in pending:
+            if not future.done():
+                future.set_result(rows[start:start + len(request_codes)])
+            start += len(request_codes)
+
+        self.batches += 1
+        self.requests += len(pending)
+        self.codes += len(codes)
+
+## Routing ##
+def read_codes(body):
+    """Codes of a batched request body, {"codes": [...]}."""
+    try:
+        codes = json.loads(body)['codes']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('expected a json body of the form {"codes": [...]}')
+    if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+        raise ValueError('"codes" must be a list of strings')
+    return codes
+
+async def route(method, path, body, batcher):
+    """Status and json payload for a request."""
+    lookups = {'icd9': lookup_icd9, 'icd10': lookup_icd10}
+    parts = path.strip('/').split('/', 2)
+
+    try:
+        if parts == ['health'] and method == 'GET':
+            return 200, {'status': 'ok', 'batches': batcher.batches, 'requests': batcher.requests, 'codes': batcher.codes}
+
+        if parts[0] == 'lookup' and len(parts) >= 2 and parts[1] in lookups:
+            lookup = lookups[parts[1]]
+            if method == 'GET' and len(parts) == 3:
+                record = lookup(parts[2])
+                return (200, record) if record else (404, {'error': f'unknown code: {parts[2]}'})
+            if method == 'POST' and len(parts) == 2:
+                return 200, {'results': [lookup(code) for code in read_codes(body)]}
+
+        if parts[0] == 'convert':
+            if method == 'GET' and len(parts) == 2:
+                return 200, (await batcher.convert([parts[1]]))[0]
+            if method == 'POST' and len(parts) == 1:
+                return 200, {'results': await batcher.convert(read_codes(body))}
+    except ValueError as error:
+        return 400, {'error': str(error)}
+
+    return 404, {'error': f'no endpoint for {method} {path}'}
+
+## HTTP ##
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large'}
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    headers = (f'HTTP/1.1 {status} {reasons[status]}\r\n'
+               f'Content-Type: application/json\r\n'
+               f'Content-Length: {len(body)}\r\n'
+               f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    writer.write(headers.encode('latin-1') + body)
+
+async def handle_connection(reader, writer, batcher):
+    """Serve the requests of one connection (kept alive between requests, as HTTP/1.1 clients expect)."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                write_response(writer, 400, {'error': 'malformed request line'}, False)
+                break
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            try:
+                length = int(headers.get('content-length', 0) or 0)
+                if length < 0:
+                    raise ValueError
+            except ValueError:
+                write_response(writer, 400, {'error': 'invalid content-length'}, False)
+                break
+            if length > max_body_size:
+                write_response(writer, 413, {'error': f'body larger than {max_body_size} bytes'}, False)
+                break
+            body = await reader.readexactly(length) if length else b''
+
+            path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+            status, payload = await route(method, path, body, batcher)
+            write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port, batch_window=default_batch_window, max_batch=default_max_batch):
+    # Tables are loaded before accepting connections, so no request waits on the csvs
+    get_tables()
+    batcher = ConversionBatcher(batch_window, max_batch)
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(reader, writer, batcher), host, port)
+    print(f"Serving icd lookups on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+## Command line ##
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP service for icd-9/icd-10 lookups and icd-9 -> icd-10 conversion.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--batch-window-ms', type=float, default=default_batch_window * 1000,
+                        help='how long conversion requests are collected before being converted together')
+    parser.add_argument('--max-batch', type=int, default=default_max_batch, help='codes which trigger an early batch')
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port, args.batch_window_ms / 1000, args.max_batch))
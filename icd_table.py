@@ -0,0 +1,149 @@
+#########################################################################################################
+#                                   COMPACT (INTERNED) CODE TABLES                                      #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: Tables of codes held as parallel columns rather than one dictionary per code. Columns with #
+#            few distinct values (category, subcategory, commoncat) are stored as arrays of integer ids #
+#            into string pools, which can be shared between tables, so each distinct string is held     #
+#            once however many codes (or tables) use it. Other columns (description) are plain lists.   #
+#            Used by the parsers to collect parsed codes, and by icd_lookup.py to hold the lookup       #
+#            tables, where a CodeTable behaves as a read-only dictionary of code -> record.             #
+#                                                                                                       #
+#   Usage:   table = CodeTable(['description', 'subcategory', 'category'])                              #
+#            table.append('001', description='cholera', subcategory='...', category='...')              #
+#            table['001'] -> {'description': 'cholera', 'subcategory': '...', 'category': '...'}        #
+#            pd.DataFrame(table.to_columns()), or table.to_frame() with pooled columns as categoricals  #
+#                                                                                                       #
+#########################################################################################################
+
+# Loading packages
+from array import array
+from collections.abc import Mapping
+
+pooled_columns = ('subcategory', 'category', 'commoncat')
+
+class StringPool:
+    """Each distinct string stored once, and referred to by an integer id (None is id -1)."""
+    __slots__ = ('strings', 'ids')
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def __getitem__(self, string_id):
+        return self.strings[string_id] if string_id >= 0 else None
+
+    def __len__(self):
+        return len(self.strings)
+
+class CodeTable(Mapping):
+    """
+    Rows of codes as parallel columns; the columns named in pooled_columns are arrays of ids into a StringPool per
+    column, taken from pools (a dictionary of column -> StringPool, shared between tables) where given. As a mapping,
+    code -> record (a dictionary of the columns) of the first row with that code, built on access.
+    """
+    __slots__ = ('columns', 'pools', 'codes', 'values', 'index', 'layout')
+
+    def __init__(self, columns, pools=None):
+        self.columns = list(columns)
+        self.pools = pools if pools is not None else {}
+        self.codes = []
+        self.values = {}
+        self.index = {}
+        for column in self.columns:
+            if column in pooled_columns:
+                self.pools.setdefault(column, StringPool())
+                self.values[column] = array('i')
+            else:
+                self.values[column] = []
+        self.set_layout()
+
+    def set_layout(self):
+        # (column, values, pool strings or None) of each column, so records are built without further lookups
+        self.layout = [(column, self.values[column], self.pools[column].strings if column in pooled_columns else None)
+                       for column in self.columns]
+
+    @classmethod
+    def from_columns(cls, codes, columns, pools=None):
+        """Table from a sequence of codes and a dictionary of column -> sequence of values (e.g. DataFrame columns)."""
+        table = cls(columns, pools)
+        table.codes = list(codes)
+        for row, code in enumerate(table.codes):
+            table.index.setdefault(code, row)
+        for column, values in columns.items():
+            if column in pooled_columns:
+                intern = table.pools[column].intern
+                table.values[column] = array('i', (intern(value) for value in values))
+            else:
+                table.values[column] = list(values)
+        table.set_layout()
+        return table
+
+    def append(self, code, **values):
+        self.index.setdefault(code, len(self.codes))
+        self.codes.append(code)
+        for column in self.columns:
+            value = values.get(column)
+            self.values[column].append(self.pools[column].intern(value) if column in pooled_columns else value)
+
+    def value(self, column, row):
+        value = self.values[column][row]
+        return self.pools[column][value] if column in pooled_columns else value
+
+    def record(self, row):
+        record = {}
+        for column, values, strings in self.layout:
+            value = values[row]
+            record[column] = value if strings is None else (strings[value] if value >= 0 else None)
+        return record
+
+    def to_columns(self, code_column='code'):
+        """Dictionary of column -> list of values (pooled columns expanded back to strings), codes first."""
+        columns = {code_column: list(self.codes)}
+        for column in self.columns:
+            if column in pooled_columns:
+                strings = self.pools[column].strings + [None]
+                columns[column] = [strings[string_id] for string_id in self.values[column]]
+            else:
+                columns[column] = list(self.values[column])
+        return columns
+
+    def to_frame(self, code_column='code'):
+        """DataFrame of the table, with the pooled columns as categoricals (their codes are the pool ids)."""
+        import numpy as np
+        import pandas as pd
+        columns = {code_column: self.codes}
+        for column in self.columns:
+            if column in pooled_columns:
+                columns[column] = pd.Categorical.from_codes(np.asarray(self.values[column]),
+                                                            categories=self.pools[column].strings)
+            else:
+                columns[column] = self.values[column]
+        return pd.DataFrame(columns)
+
+    # Read-only mapping of code -> record
+    def __getitem__(self, code):
+        return self.record(self.index[code])
+
+    def get(self, code, default=None):
+        row = self.index.get(code)
+        return self.record(row) if row is not None else default
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, code):
+        return code in self.index
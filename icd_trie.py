@@ -0,0 +1,59 @@
+#########################################################################################################
+#                                   ICD CODE PREFIX TRIE                                                #
+#                                                                                                       #
+#   Date:    October 2026                                                                               #
+#                                                                                                       #
+#   Purpose: Codes in EHRs come in many forms (250.01, 25001, E11.65, e1165). Rather than handling each #
+#            form with its own regex, the codes of a parsed lookup table are held in a trie keyed on    #
+#            their characters without the decimal point. A single walk along an incoming code then:     #
+#                 normalises it to the form used in the lookup table (25001 -> 250.01);                 #
+#                 rolls it up to its 3-character 'part' parent (250.01 -> 250);                         #
+#                 falls back to the longest valid prefix when the code itself is unknown.               #
+#                                                                                                       #
+#   Usage:   trie = build_code_trie(df['code'])                                                         #
+#            resolve_code(trie, '25001') -> ('250.01', '250', True)                                     #
+#                                                                                                       #
+#########################################################################################################
+
+# Key under which a trie node stores the table code ending at that node (None, so it cannot clash with a character)
+code_end = None
+
+part_length = 3
+
+def code_key(code):
+    """Characters a code is stored under in the trie: lowercase, with whitespace and decimal points removed."""
+    return ''.join(str(code).lower().split()).replace('.', '')
+
+def build_code_trie(codes):
+    """Build a trie of nested dictionaries from the codes of a lookup table."""
+    trie = {}
+    for code in codes:
+        node = trie
+        for char in code_key(code):
+            node = node.setdefault(char, {})
+        node[code_end] = code
+    return trie
+
+def resolve_code(trie, code):
+    """
+    Walk the trie along a raw code. Returns (code, part_code, exact):
+        code: the lookup table code, or its longest valid prefix if the code is unknown (None if neither)
+        part_code: the 3-character 'part' parent of the code (None if it has none)
+        exact: whether the whole code is a valid code
+    """
+    key = code_key(code)
+    node = trie
+    matched = part = None
+    matched_depth = 0
+
+    for depth, char in enumerate(key, 1):
+        node = node.get(char)
+        if node is None:
+            break
+        if code_end in node:
+            matched = node[code_end]
+            matched_depth = depth
+            if depth == part_length:
+                part = matched
+
+    return matched, part, bool(key) and matched_depth == len(key)